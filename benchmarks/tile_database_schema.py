@@ -0,0 +1,134 @@
+""" compares point lookups and range scans of the default tile database layout with schema version 2
+
+    usage: python benchmarks/tile_database_schema.py [--tiles 10000000] [--path tile_benchmark.db]
+
+    builds a database with synthetic tiles of one tile server at zoom level 16 and validation data for every tile, measures it,
+    migrates it to schema version 2 with migrate_tile_database and measures it again,
+    the database file is kept for further runs with --reuse """
+
+import argparse
+import math
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from tkintermapview.tile_database import create_tables, migrate_tile_database, TileTable, LAYOUT_DEFAULT, LAYOUT_V2
+
+TILE_SERVER = "https://a.tile.openstreetmap.org/{z}/{x}/{y}.png"
+ZOOM = 16
+X_OFFSET, Y_OFFSET = 34000, 21000
+
+
+def build_database(path: str, number_of_tiles: int):
+    """ square region of tiles, a third of them are the same 'ocean' tile, the others are distinct,
+        every tile has an ETag and an expiry time like tiles stored by the write-through cache """
+
+    db_connection = sqlite3.connect(path)
+    db_cursor = db_connection.cursor()
+    db_cursor.execute("PRAGMA journal_mode=OFF;")
+    db_cursor.execute("PRAGMA synchronous=OFF;")
+    create_tables(db_cursor, layout=LAYOUT_DEFAULT)
+    db_cursor.execute("INSERT OR IGNORE INTO server (url, max_zoom) VALUES (?, ?);", (TILE_SERVER, 19))
+
+    side = math.ceil(math.sqrt(number_of_tiles))
+    ocean_tile = bytes(200)
+    expires = time.time() + 7 * 24 * 60 * 60
+    rows, validation_rows = [], []
+    for i in range(number_of_tiles):
+        x, y = X_OFFSET + i // side, Y_OFFSET + i % side
+        tile_image = ocean_tile if i % 3 == 0 else i.to_bytes(8, "little") * 25
+        rows.append((ZOOM, x, y, TILE_SERVER, tile_image))
+        validation_rows.append((ZOOM, x, y, TILE_SERVER, f'"{i:016x}"', "Mon, 01 Jan 2024 00:00:00 GMT", expires))
+
+        if len(rows) == 100000 or i == number_of_tiles - 1:
+            db_cursor.executemany("INSERT INTO tiles (zoom, x, y, server, tile_image) VALUES (?, ?, ?, ?, ?);", rows)
+            db_cursor.executemany("""INSERT INTO tile_validation (zoom, x, y, server, etag, last_modified, expires)
+                                     VALUES (?, ?, ?, ?, ?, ?, ?);""", validation_rows)
+            db_connection.commit()
+            rows.clear()
+            validation_rows.clear()
+    db_connection.close()
+    return side
+
+
+def measure(path: str, side: int, number_of_tiles: int, number_of_lookups: int, number_of_scans: int) -> dict:
+    tile_table = TileTable(sqlite3.connect(path).cursor())
+    random.seed(1)
+
+    # warm up the page cache, so that both layouts are measured in the same state
+    for i in range(min(number_of_lookups, 10000)):
+        index = random.randrange(number_of_tiles)
+        tile_table.get_tile(ZOOM, X_OFFSET + index // side, Y_OFFSET + index % side, TILE_SERVER)
+
+    lookup_times = []
+    for i in range(number_of_lookups):
+        index = random.randrange(number_of_tiles)
+        start_time = time.perf_counter()
+        tile_table.get_tile(ZOOM, X_OFFSET + index // side, Y_OFFSET + index % side, TILE_SERVER)
+        lookup_times.append(time.perf_counter() - start_time)
+
+    # validation data is read with every tile the map widget loads from the database
+    validation_times = []
+    for i in range(number_of_lookups):
+        index = random.randrange(number_of_tiles)
+        start_time = time.perf_counter()
+        tile_table.get_tile_validation(ZOOM, X_OFFSET + index // side, Y_OFFSET + index % side, TILE_SERVER)
+        validation_times.append(time.perf_counter() - start_time)
+
+    # range scans over a rectangle of 32 x 32 tiles, like the OfflineLoader does for every zoom level
+    scan_times = []
+    for i in range(number_of_scans):
+        x, y = X_OFFSET + random.randrange(max(1, side - 32)), Y_OFFSET + random.randrange(max(1, side - 32))
+        start_time = time.perf_counter()
+        tile_table.get_stored_tiles(ZOOM, TILE_SERVER, range(x, x + 32), range(y, y + 32))
+        scan_times.append(time.perf_counter() - start_time)
+
+    tile_table.db_cursor.connection.close()
+    lookup_times.sort()
+    return {"layout": tile_table.layout,
+            "lookup_mean_us": statistics.mean(lookup_times) * 1e6,
+            "lookup_p99_us": lookup_times[int(len(lookup_times) * 0.99)] * 1e6,
+            "validation_mean_us": statistics.mean(validation_times) * 1e6,
+            "scan_mean_ms": statistics.mean(scan_times) * 1e3,
+            "file_size_mb": os.path.getsize(path) / 1024 ** 2}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tiles", type=int, default=10_000_000)
+    parser.add_argument("--path", default="tile_benchmark.db")
+    parser.add_argument("--lookups", type=int, default=100000)
+    parser.add_argument("--scans", type=int, default=1000)
+    parser.add_argument("--reuse", action="store_true", help="use an existing database in the default layout")
+    args = parser.parse_args()
+
+    if not args.reuse:
+        if os.path.exists(args.path):
+            os.remove(args.path)
+        start_time = time.perf_counter()
+        side = build_database(args.path, args.tiles)
+        print(f"built database with {args.tiles} tiles in {time.perf_counter() - start_time:.1f} s")
+    else:
+        side = math.ceil(math.sqrt(args.tiles))
+
+    results = [measure(args.path, side, args.tiles, args.lookups, args.scans)]
+
+    start_time = time.perf_counter()
+    migrate_tile_database(args.path, layout=LAYOUT_V2)
+    print(f"migrated to schema version 2 in {time.perf_counter() - start_time:.1f} s")
+
+    results.append(measure(args.path, side, args.tiles, args.lookups, args.scans))
+
+    print(f"{'layout':<10}{'lookup mean':>14}{'lookup p99':>14}{'validation':>14}{'32x32 scan':>14}{'file size':>14}")
+    for result in results:
+        print(f"{result['layout']:<10}{result['lookup_mean_us']:>11.1f} us{result['lookup_p99_us']:>11.1f} us"
+              f"{result['validation_mean_us']:>11.1f} us{result['scan_mean_ms']:>11.2f} ms{result['file_size_mb']:>11.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import unittest
+from email.utils import formatdate
+
+from tkintermapview.tile_session import get_retry_after, is_image_response
+
+
+class TestRetryAfter(unittest.TestCase):
+    def test_seconds(self):
+        self.assertEqual(get_retry_after({"Retry-After": "120"}), 120.0)
+
+    def test_http_date(self):
+        now = 1700000000.0
+        retry_after = get_retry_after({"Retry-After": formatdate(now + 30, usegmt=True)}, now=now)
+        self.assertAlmostEqual(retry_after, 30.0)
+
+    def test_date_in_the_past(self):
+        now = 1700000000.0
+        self.assertEqual(get_retry_after({"Retry-After": formatdate(now - 30, usegmt=True)}, now=now), 0.0)
+
+    def test_missing_or_invalid(self):
+        self.assertIsNone(get_retry_after({}))
+        self.assertIsNone(get_retry_after({"Retry-After": "soon"}))
+
+
+class TestImageResponse(unittest.TestCase):
+    def test_image_types(self):
+        self.assertTrue(is_image_response({"Content-Type": "image/png"}))
+        self.assertTrue(is_image_response({"Content-Type": "application/octet-stream"}))
+        self.assertTrue(is_image_response({}))
+
+    def test_error_pages(self):
+        self.assertFalse(is_image_response({"Content-Type": "text/html; charset=utf-8"}))
+        self.assertFalse(is_image_response({"Content-Type": "application/json"}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+from unittest import mock
+
+from tkintermapview.tile_throttling import AdaptiveConcurrencyLimiter, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_pause_with_unlimited_rate(self):
+        # the default TileSessionPool has no requests_per_second, a Retry-After header must pause it anyway
+        clock = FakeClock()
+        with mock.patch("tkintermapview.tile_throttling.time", clock):
+            bucket = TokenBucket(None)
+            bucket.acquire()
+            self.assertEqual(clock.now, 1000.0)
+
+            bucket.pause(5)
+            bucket.acquire()
+        self.assertGreaterEqual(clock.now, 1005.0)
+
+    def test_pause_with_rate(self):
+        clock = FakeClock()
+        with mock.patch("tkintermapview.tile_throttling.time", clock):
+            bucket = TokenBucket(10)
+            bucket.pause(2)
+            bucket.acquire()
+        self.assertGreaterEqual(clock.now, 1002.0)
+
+
+class TestAdaptiveConcurrencyLimiter(unittest.TestCase):
+    def run_requests(self, limiter: AdaptiveConcurrencyLimiter, clock: FakeClock, latency: float, number_of_requests: int):
+        for i in range(number_of_requests):
+            limiter.acquire()
+            clock.now += latency
+            limiter.release(latency)
+
+    def test_limit_grows_at_constant_latency(self):
+        clock = FakeClock()
+        with mock.patch("tkintermapview.tile_throttling.time", clock):
+            limiter = AdaptiveConcurrencyLimiter(initial_limit=8, max_limit=50)
+            self.run_requests(limiter, clock, 0.05, 2000)
+        self.assertEqual(int(limiter.limit), 50)
+
+    def test_limit_recovers_after_permanent_latency_increase(self):
+        # for example a change from a LAN to a mobile connection, the higher latency is the new baseline
+        clock = FakeClock()
+        with mock.patch("tkintermapview.tile_throttling.time", clock):
+            limiter = AdaptiveConcurrencyLimiter(initial_limit=8, max_limit=50)
+            self.run_requests(limiter, clock, 0.01, 500)
+            self.run_requests(limiter, clock, 0.5, 200)
+            self.assertLess(limiter.limit, 8)
+
+            self.run_requests(limiter, clock, 0.5, 2000)
+        self.assertEqual(int(limiter.limit), 50)
+
+    def test_throttled_responses_halve_the_limit(self):
+        clock = FakeClock()
+        with mock.patch("tkintermapview.tile_throttling.time", clock):
+            limiter = AdaptiveConcurrencyLimiter(initial_limit=16)
+            limiter.acquire()
+            clock.now += 0.05
+            limiter.release(0.05, throttled=True)
+        self.assertEqual(int(limiter.limit), 8)
+        self.assertEqual(limiter.number_of_throttled_responses, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
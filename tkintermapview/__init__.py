@@ -2,5 +2,9 @@ __version__ = "1.30"
 
 from .map_widget import TkinterMapView
 from .offline_loading import OfflineLoader
+from .tile_session import TileSessionPool
+from .tile_service import TileService
+from .tile_database import deduplicate_tile_database, migrate_tile_database
+from .mbtiles import MBTilesSource, export_mbtiles, import_mbtiles
 from .utility_functions import convert_coordinates_to_address, convert_coordinates_to_country, convert_coordinates_to_city
 from .utility_functions import decimal_to_osm, osm_to_decimal
@@ -0,0 +1,54 @@
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, Hashable
+
+
+class InFlightRegistry:
+    """ coalesces concurrent requests for the same key, so that only the first one does the actual work
+        and all others wait for its result """
+
+    def __init__(self):
+        self.futures: Dict[Hashable, Future] = {}
+        self.lock = threading.Lock()
+
+        self.number_of_requests = 0  # requests that did the actual work
+        self.number_of_coalesced_requests = 0  # requests that got the result of an already running request
+
+    def run(self, key: Hashable, function: Callable, *args, **kwargs):
+        """ returns function(*args, **kwargs), or the result of the call for the same key that is already in flight """
+
+        with self.lock:
+            future = self.futures.get(key)
+            if future is None:
+                future = Future()
+                self.futures[key] = future
+                self.number_of_requests += 1
+                is_owner = True
+            else:
+                self.number_of_coalesced_requests += 1
+                is_owner = False
+
+        if not is_owner:
+            return future.result()
+
+        try:
+            result = function(*args, **kwargs)
+        except BaseException as err:
+            future.set_exception(err)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.futures[key]
+
+    def is_in_flight(self, key: Hashable) -> bool:
+        with self.lock:
+            return key in self.futures
+
+    def get_statistics(self) -> Dict[str, int]:
+        with self.lock:
+            return {"in_flight": len(self.futures),
+                    "requests": self.number_of_requests,
+                    "coalesced_requests": self.number_of_coalesced_requests}
@@ -1,4 +1,3 @@
-import requests
 import math
 import threading
 import tkinter
@@ -7,16 +6,16 @@ import tkinter.messagebox
 import time
 import PIL
 import sys
-import io
-import sqlite3
 import pyperclip
 import ssl
 import certifi
 from geopy.geocoders import Nominatim
 from geopy.exc import GeocoderTimedOut, GeocoderUnavailable
 from PIL import Image, ImageTk
-from typing import Callable, List, Dict, Union, Tuple
+from typing import Callable, List, Union, Tuple
 from functools import partial
+from collections import deque
+from concurrent.futures import Future
 
 from .canvas_position_marker import CanvasPositionMarker
 from .canvas_tile import CanvasTile
@@ -24,6 +23,13 @@ from .utility_functions import decimal_to_osm, osm_to_decimal
 from .canvas_button import CanvasButton
 from .canvas_path import CanvasPath
 from .canvas_polygon import CanvasPolygon
+from .tile_session import TileSessionPool
+from .tile_cache import TileImageCache
+from .tile_decoding import decode_tile_image, decode_placeholder_image
+from .prefetch_planner import PrefetchPlanner
+from .tile_layer import TileLayer
+from .tile_service import TileService
+from .tile_database import TileTable
 
 
 class TkinterMapView(tkinter.Frame):
@@ -34,7 +40,20 @@ class TkinterMapView(tkinter.Frame):
                  bg_color: str = None,
                  database_path: str = None,
                  use_database_only: bool = False,
+                 persistent_tile_cache: bool = False,
+                 tile_cache_size_limit: int = 500 * 1024 ** 2,
+                 default_tile_ttl: float = 7 * 24 * 60 * 60,
+                 memory_cache_size_limit: int = 128 * 1024 ** 2,
+                 tile_data_cache_size_limit: int = 256 * 1024 ** 2,
                  max_zoom: int = 19,
+                 session_pool: TileSessionPool = None,
+                 tile_loader_threads: int = 25,
+                 decode_workers: int = 2,
+                 decode_in_processes: bool = False,
+                 frame_time_budget: float = 8,
+                 prefetch_tile_budget: int = 200,
+                 negative_cache_ttl: float = 60 * 60,
+                 tile_service: TileService = None,
                  **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -109,6 +128,10 @@ class TkinterMapView(tkinter.Frame):
         self.move_velocity: Tuple[float, float] = (0, 0)
         self.last_move_time: Union[float, None] = None
 
+        # last mouse wheel zoom, the next zoom level in this direction gets prefetched
+        self.last_zoom_direction: int = 0
+        self.last_zoom_direction_time: float = 0
+
         # describes the tile layout
         self.zoom: float = 0
         self.upper_left_tile_pos: Tuple[float, float] = (0, 0)  # in OSM coords
@@ -122,35 +145,68 @@ class TkinterMapView(tkinter.Frame):
         self.canvas_path_list: List[CanvasPath] = []
         self.canvas_polygon_list: List[CanvasPolygon] = []
 
-        self.tile_image_cache: Dict[str, PIL.ImageTk.PhotoImage] = {}
+        # two cache tiers: a small one for decoded images of the visible area and its surroundings, and a large one in the
+        # tile service for the encoded tile data (~10x smaller), which gets decoded again when needed
+        # images are composites of the map tile and the visible overlay layers, so they are cached per tile server and layer combination,
+        # the tile data of every layer is cached separately under its own server, all servers share the memory budget,
+        # so switching back to a recently used tile server shows its tiles immediately
+        self.tile_image_cache = TileImageCache(memory_cache_size_limit, is_pinned=self.is_tile_visible)  # key: (zoom, x, y, layer_key)
+
+        # placeholders which are shown until a tile is loaded, made of cached tiles of other zoom levels in the decode pool,
+        # the sources are the decoded images of the last loaded tiles, or the encoded tile data if they are not decoded anymore
+        self.placeholder_image_cache = TileImageCache(32 * 1024 ** 2)  # key: (zoom, x, y, layer_key)
+        self.placeholder_source_cache = TileImageCache(self.get_placeholder_source_cache_size())  # decoded PIL images, key: (zoom, x, y, layer_key)
+        self.placeholder_requests = set()  # placeholders which are built in the decode pool, key: (zoom, x, y, layer_key)
         self.empty_tile_image = ImageTk.PhotoImage(Image.new("RGB", (self.tile_size, self.tile_size), (190, 190, 190)))  # used for zooming and moving
         self.not_loaded_tile_image = ImageTk.PhotoImage(Image.new("RGB", (self.tile_size, self.tile_size), (250, 250, 250)))  # only used when image not found on tile server
 
-        # tile server and database
+        # tile server and tile loading pipeline (loader threads, decode pool, tile data cache and database),
+        # shared with other widgets if a tile_service is given, then the arguments for the pipeline are ignored
         self.tile_server = "https://a.tile.openstreetmap.org/{z}/{x}/{y}.png"
-        self.database_path = database_path
-        self.use_database_only = use_database_only
-        self.overlay_tile_server: Union[str, None] = None
+        if tile_service is None:
+            self.tile_service = TileService(database_path=database_path,
+                                            use_database_only=use_database_only,
+                                            persistent_tile_cache=persistent_tile_cache,
+                                            tile_cache_size_limit=tile_cache_size_limit,
+                                            default_tile_ttl=default_tile_ttl,
+                                            tile_data_cache_size_limit=tile_data_cache_size_limit,
+                                            session_pool=session_pool,
+                                            tile_loader_threads=tile_loader_threads,
+                                            decode_workers=decode_workers,
+                                            decode_in_processes=decode_in_processes,
+                                            negative_cache_ttl=negative_cache_ttl)
+            self.owns_tile_service = True
+        else:
+            self.tile_service = tile_service
+            self.owns_tile_service = False
+        self.tile_service.get_tile_url_template(self.tile_server)  # keeps the subdomains if another widget registered the server
+
+        self.overlay_tile_server: Union[str, None] = None  # server of the last set_overlay_tile_server call
+        self.overlay_layers: List[TileLayer] = []  # drawn over the map tiles in this order
+        self.layer_key: tuple = (self.tile_server, ())  # (tile_server, ((server, opacity) of the visible overlay layers, ...))
         self.max_zoom = max_zoom  # should be set according to tile server max zoom
         self.min_zoom: int = math.ceil(math.log2(math.ceil(self.width / self.tile_size)))  # min zoom at which map completely fills widget
 
-        # pre caching for smoother movements (load tile images into cache at a certain radius around the pre_cache_position)
+        # pre caching for smoother movements, prefetches the tiles in the direction of movement and zoom
         self.pre_cache_position: Union[Tuple[float, float], None] = None
+        self.pre_cache_event = threading.Event()  # set when pre_cache_position changes, pre_cache thread sleeps otherwise
+        self.prefetch_planner = PrefetchPlanner(tile_budget=prefetch_tile_budget)
+
+        # image loading in the background threads of the tile service, visible tiles are loaded first, beginning at the middle of the map
+        self.image_load_queue_tasks = self.tile_service.attach(self)  # task: ((zoom, x, y), canvas_tile_object) or ((zoom, x, y), None, rank in prefetch plan)
+        self.image_load_queue_results = deque()  # result: ((zoom, x, y), canvas_tile_object, photo_image or decoded PIL image, time of result)
+        self.results_signal_pending = False  # True if a <<TileImagesLoaded>> event is already on its way to the main thread
+        self.results_signal_failed = False  # True if the event could not be generated, because Tk is driven by update() instead of mainloop()
+        self.results_signal_lock = threading.Lock()
+        self.result_statistics = {"applied_results": 0, "max_queue_depth": 0, "total_apply_latency": 0.0, "max_apply_latency": 0.0,
+                                  "last_update_duration": 0.0}
+        self.bind("<<TileImagesLoaded>>", self.update_canvas_tile_images)
+        self.after(10, self.check_tile_load_results)  # apply results that arrived before the mainloop was started or without event
+        self.frame_time_budget = frame_time_budget  # milliseconds per update for creating PhotoImages in the main thread
+
         self.pre_cache_thread = threading.Thread(daemon=True, target=self.pre_cache)
         self.pre_cache_thread.start()
 
-        # image loading in background threads
-        self.image_load_queue_tasks: List[tuple] = []  # task: ((zoom, x, y), canvas_tile_object)
-        self.image_load_queue_results: List[tuple] = []  # result: ((zoom, x, y), canvas_tile_object, photo_image)
-        self.after(10, self.update_canvas_tile_images)
-        self.image_load_thread_pool: List[threading.Thread] = []
-
-        # add background threads which load tile images from self.image_load_queue_tasks
-        for i in range(25):
-            image_load_thread = threading.Thread(daemon=True, target=self.load_images_background)
-            image_load_thread.start()
-            self.image_load_thread_pool.append(image_load_thread)
-
         # set initial position
         self.set_zoom(17)
         self.set_position(52.516268, 13.377695)  # Brandenburger Tor, Berlin
@@ -166,6 +222,16 @@ class TkinterMapView(tkinter.Frame):
 
     def destroy(self):
         self.running = False
+
+        # cancel waiting tasks and wake up the sleeping pre_cache thread, so that it can exit
+        self.image_load_queue_tasks.close()
+        self.pre_cache_event.set()
+
+        # stop the loader threads and commit tiles that are not written to the database yet, unless other widgets use them
+        self.tile_service.detach(self)
+        if self.owns_tile_service:
+            self.tile_service.close()
+
         super().destroy()
 
     def draw_rounded_corners(self):
@@ -194,6 +260,7 @@ class TkinterMapView(tkinter.Frame):
             self.width = event.width
             self.height = event.height
             self.min_zoom = math.ceil(math.log2(math.ceil(self.width / self.tile_size)))
+            self.placeholder_source_cache.size_limit = self.get_placeholder_source_cache_size()
 
             self.set_zoom(self.zoom)  # call zoom to set the position vertices right
             self.draw_move()  # call move to draw new tiles or delete tiles
@@ -244,18 +311,59 @@ class TkinterMapView(tkinter.Frame):
 
         m.tk_popup(event.x_root, event.y_root)  # display menu
 
-    def set_overlay_tile_server(self, overlay_server: str):
+    def set_overlay_tile_server(self, overlay_server: Union[str, None], subdomains: str = "abc"):
+        """ replaces all overlay layers with one layer of overlay_server, None removes all overlay layers,
+            subdomains: hosts for the {s} placeholder of the url, for example "abc" """
+
+        for layer in self.overlay_layers:
+            layer.deleted = True
+        self.overlay_layers = []
         self.overlay_tile_server = overlay_server
 
-    def set_tile_server(self, tile_server: str, tile_size: int = 256, max_zoom: int = 19):
-        self.image_load_queue_tasks = []
+        if overlay_server is not None:
+            self.add_overlay_layer(overlay_server, subdomains=subdomains)
+        else:
+            self.update_tile_layers()
+
+    def add_overlay_layer(self, tile_server: str, opacity: float = 1.0, subdomains: str = "abc", name: str = None) -> TileLayer:
+        """ adds a layer of tile_server over the map and the other overlay layers,
+            subdomains: hosts for the {s} placeholder of the url, for example "abc" """
+
+        self.tile_service.set_url_template(tile_server, subdomains)
+        layer = TileLayer(self, tile_server, opacity=max(0.0, min(1.0, opacity)), name=name)
+        self.overlay_layers.append(layer)
+        self.update_tile_layers()
+        return layer
+
+    def update_tile_layers(self):
+        """ called when overlay layers change, shows the cached images of the new layer combination and loads the missing ones,
+            until then the current images stay visible """
+
+        self.layer_key = (self.tile_server, tuple((layer.tile_server, layer.opacity) for layer in self.overlay_layers if layer.visible))
+
+        for canvas_tile_column in self.canvas_tile_array:
+            for canvas_tile in canvas_tile_column:
+                image = self.get_tile_image_from_cache(round(self.zoom), *canvas_tile.tile_name_position)
+                if image is False:
+                    self.image_load_queue_tasks.put(((round(self.zoom), *canvas_tile.tile_name_position), canvas_tile))
+                else:
+                    canvas_tile.set_image(image)
+
+    def set_tile_server(self, tile_server: str, tile_size: int = 256, max_zoom: int = 19, subdomains: str = "abc"):
+        """ subdomains: hosts for the {s} placeholder of the url, for example "abc",
+            cached tiles of the previous tile servers are kept, so switching back to them is instant """
+
+        self.tile_service.set_url_template(tile_server, subdomains)
+
+        # cancel the waiting tasks of the old tile server, tiles which are already loading still get cached,
+        # and their results are not shown, because they belong to another layer_key
+        self.image_load_queue_tasks.clear()
+
         self.max_zoom = max_zoom
         self.tile_size = tile_size
         self.min_zoom = math.ceil(math.log2(math.ceil(self.width / self.tile_size)))
         self.tile_server = tile_server
-        self.tile_image_cache: Dict[str, PIL.ImageTk.PhotoImage] = {}
-        self.canvas.delete("tile")
-        self.image_load_queue_results = []
+        self.layer_key = (tile_server, self.layer_key[1])
         self.draw_initial_array()
 
     def get_position(self) -> tuple:
@@ -428,174 +536,358 @@ class TkinterMapView(tkinter.Frame):
         self.canvas.lift("corner")
         self.canvas.lift("button")
 
-    def pre_cache(self):
-        """ single threaded pre-chache tile images in area of self.pre_cache_position """
+    def update_pre_cache_position(self):
+        """ set pre_cache_position to the middle tile of the map and wake up the pre_cache thread """
 
-        last_pre_cache_position = None
-        radius = 1
-        zoom = round(self.zoom)
+        pre_cache_position = (round((self.upper_left_tile_pos[0] + self.lower_right_tile_pos[0]) / 2),
+                              round((self.upper_left_tile_pos[1] + self.lower_right_tile_pos[1]) / 2))
 
-        if self.database_path is not None:
-            db_connection = sqlite3.connect(self.database_path)
-            db_cursor = db_connection.cursor()
-        else:
-            db_cursor = None
+        if pre_cache_position != self.pre_cache_position:
+            self.pre_cache_position = pre_cache_position
+            self.image_load_queue_tasks.reprioritize()  # middle of map changed, so the loading order changes too
 
-        while self.running:
-            if last_pre_cache_position != self.pre_cache_position:
-                last_pre_cache_position = self.pre_cache_position
-                zoom = round(self.zoom)
-                radius = 1
-
-            if last_pre_cache_position is not None and radius <= 8:
-
-                # pre cache top and bottom row
-                for x in range(self.pre_cache_position[0] - radius, self.pre_cache_position[0] + radius + 1):
-                    if f"{zoom}{x}{self.pre_cache_position[1] + radius}" not in self.tile_image_cache:
-                        self.request_image(zoom, x, self.pre_cache_position[1] + radius, db_cursor=db_cursor)
-                    if f"{zoom}{x}{self.pre_cache_position[1] - radius}" not in self.tile_image_cache:
-                        self.request_image(zoom, x, self.pre_cache_position[1] - radius, db_cursor=db_cursor)
-
-                # pre cache left and right column
-                for y in range(self.pre_cache_position[1] - radius, self.pre_cache_position[1] + radius + 1):
-                    if f"{zoom}{self.pre_cache_position[0] + radius}{y}" not in self.tile_image_cache:
-                        self.request_image(zoom, self.pre_cache_position[0] + radius, y, db_cursor=db_cursor)
-                    if f"{zoom}{self.pre_cache_position[0] - radius}{y}" not in self.tile_image_cache:
-                        self.request_image(zoom, self.pre_cache_position[0] - radius, y, db_cursor=db_cursor)
-
-                # raise the radius
-                radius += 1
+        self.pre_cache_event.set()
 
-            else:
-                time.sleep(0.1)
+    def get_tile_load_priority(self, task: tuple) -> tuple:
+        """ visible tiles ordered by distance to the middle of the map, then pre-cache tiles in the order of the prefetch plan """
 
-            # 10_000 images = 80 MB RAM-usage
-            if len(self.tile_image_cache) > 10_000:  # delete random tiles if cache is too large
-                # create list with keys to delete
-                keys_to_delete = []
-                for key in self.tile_image_cache.keys():
-                    if len(self.tile_image_cache) - len(keys_to_delete) > 10_000:
-                        keys_to_delete.append(key)
+        (zoom, x, y), canvas_tile = task[:2]
+        if canvas_tile is None:
+            return 1, task[2]
 
-                # delete keys in list so that len(self.tile_image_cache) == 10_000
-                for key in keys_to_delete:
-                    del self.tile_image_cache[key]
+        middle_x = (self.upper_left_tile_pos[0] + self.lower_right_tile_pos[0]) / 2
+        middle_y = (self.upper_left_tile_pos[1] + self.lower_right_tile_pos[1]) / 2
+        distance = (x + 0.5 - middle_x) ** 2 + (y + 0.5 - middle_y) ** 2
 
-    def request_image(self, zoom: int, x: int, y: int, db_cursor=None) -> ImageTk.PhotoImage:
+        return 0, distance
 
-        # if database is available check first if tile is in database, if not try to use server
-        if db_cursor is not None:
-            try:
-                db_cursor.execute("SELECT t.tile_image FROM tiles t WHERE t.zoom=? AND t.x=? AND t.y=? AND t.server=?;",
-                                  (zoom, x, y, self.tile_server))
-                result = db_cursor.fetchone()
-
-                if result is not None:
-                    image = Image.open(io.BytesIO(result[0]))
-                    image_tk = ImageTk.PhotoImage(image)
-                    self.tile_image_cache[f"{zoom}{x}{y}"] = image_tk
-                    return image_tk
-                elif self.use_database_only:
-                    return self.empty_tile_image
-                else:
-                    pass
+    def is_tile_load_task_stale(self, task: tuple) -> bool:
+        """ task belongs to an old zoom level, or its canvas tile got moved or scrolled out of view,
+            pre-cache tasks may belong to the neighbouring zoom levels """
 
-            except sqlite3.OperationalError:
-                if self.use_database_only:
-                    return self.empty_tile_image
-                else:
-                    pass
+        (zoom, x, y), canvas_tile = task[:2]
+        if canvas_tile is None:
+            return abs(zoom - round(self.zoom)) > 1
 
-            except Exception:
-                return self.empty_tile_image
+        if zoom != round(self.zoom):
+            return True
 
-        # try to get the tile from the server
-        try:
-            url = self.tile_server.replace("{x}", str(x)).replace("{y}", str(y)).replace("{z}", str(zoom))
-            image = Image.open(requests.get(url, stream=True, headers={"User-Agent": "TkinterMapView"}).raw)
+        if canvas_tile.tile_name_position != (x, y):
+            return True
+        if not (math.floor(self.upper_left_tile_pos[0]) - 1 <= x <= math.ceil(self.lower_right_tile_pos[0]) and
+                math.floor(self.upper_left_tile_pos[1]) - 1 <= y <= math.ceil(self.lower_right_tile_pos[1])):
+            return True
 
-            if self.overlay_tile_server is not None:
-                url = self.overlay_tile_server.replace("{x}", str(x)).replace("{y}", str(y)).replace("{z}", str(zoom))
-                image_overlay = Image.open(requests.get(url, stream=True, headers={"User-Agent": "TkinterMapView"}).raw)
-                image = image.convert("RGBA")
-                image_overlay = image_overlay.convert("RGBA")
+        return False
 
-                if image_overlay.size is not (self.tile_size, self.tile_size):
-                    image_overlay = image_overlay.resize((self.tile_size, self.tile_size), Image.ANTIALIAS)
+    def get_prefetch_velocity(self) -> Tuple[float, float]:
+        """ current movement of the map in tiles per second, (0, 0) if the map is not moving """
 
-                image.paste(image_overlay, (0, 0), image_overlay)
+        last_movement_time = max(self.last_mouse_down_time or 0, self.last_move_time or 0)
+        if time.time() - last_movement_time > 0.3:
+            return 0, 0
+        return self.move_velocity[0] / self.tile_size, self.move_velocity[1] / self.tile_size
 
-            if self.running:
-                image_tk = ImageTk.PhotoImage(image)
+    def pre_cache(self):
+        """ pre-cache tile data around the map as planned by self.prefetch_planner, the tiles are loaded with low priority
+            by the tile loader threads, a new plan replaces the waiting tasks of the last one """
+
+        last_pre_cache_state = None
+
+        while self.running:
+            # sleep until pre_cache_position changes or the widget gets destroyed
+            self.pre_cache_event.wait()
+            self.pre_cache_event.clear()
+
+            pre_cache_position, zoom = self.pre_cache_position, round(self.zoom)
+            if pre_cache_position is None:
+                continue
+
+            velocity = self.get_prefetch_velocity()
+            zoom_direction = self.last_zoom_direction if time.time() - self.last_zoom_direction_time < 1 else 0
+
+            # only plan again if the middle tile, the zoom level or the direction and magnitude of the movement changed
+            speed = math.hypot(*velocity)
+            if speed > 0.5:
+                movement_state = (round(math.atan2(velocity[1], velocity[0]) / (math.pi / 4)), int(math.log2(speed)))
             else:
-                return self.empty_tile_image
+                movement_state = None
+
+            pre_cache_state = (pre_cache_position, zoom, movement_state, zoom_direction, self.layer_key)
+            if pre_cache_state == last_pre_cache_state:
+                continue
+            last_pre_cache_state = pre_cache_state
+
+            plan = self.prefetch_planner.plan(self.upper_left_tile_pos, self.lower_right_tile_pos, zoom,
+                                              velocity=velocity, zoom_direction=zoom_direction,
+                                              min_zoom=self.min_zoom, max_zoom=self.max_zoom)
 
-            self.tile_image_cache[f"{zoom}{x}{y}"] = image_tk
-            return image_tk
+            # cancel pre-cache tasks of the last plan, that are still waiting
+            self.image_load_queue_tasks.discard(lambda task: task[1] is None)
 
-        except PIL.UnidentifiedImageError:  # image does not exist for given coordinates
-            self.tile_image_cache[f"{zoom}{x}{y}"] = self.empty_tile_image
-            return self.empty_tile_image
+            for rank, tile_key in enumerate(plan):
+                if (*tile_key, self.layer_key) not in self.tile_image_cache and (self.tile_server, *tile_key) not in self.tile_service.tile_data_cache:
+                    self.image_load_queue_tasks.put((tile_key, None, rank))
 
-        except requests.exceptions.ConnectionError:
-            return self.empty_tile_image
+    def request_image(self, zoom: int, x: int, y: int, canvas_tile: CanvasTile, tile_table: TileTable = None):
+        """ load tile data of the tile server and the visible overlay layers in parallel and decode it in the decode pool,
+            the decoded image gets passed to the main thread in image_load_queue_results """
+
+        layer_key = self.layer_key
+        tile_server, overlay_layers = layer_key
+        try:
+            overlay_futures = [self.tile_service.layer_load_executor.submit(self.tile_service.request_layer_tile_data, server, zoom, x, y)
+                               for server, opacity in overlay_layers]
+        except RuntimeError:  # layer load pool is shut down, because the widget got destroyed
+            return
 
+        image_data = self.tile_service.request_tile_data(tile_server, zoom, x, y, tile_table=tile_table)
+        overlays = [(future.result(), opacity) for future, (server, opacity) in zip(overlay_futures, overlay_layers)]
+
+        if image_data is None:
+            self.put_tile_load_result((zoom, x, y), canvas_tile, self.empty_tile_image, layer_key)
+            return
+
+        try:
+            future = self.tile_service.decode_executor.submit(decode_tile_image, image_data, overlays)
+        except RuntimeError:  # decode pool is shut down, because the widget got destroyed
+            return
+        future.add_done_callback(partial(self.tile_image_decoded, (zoom, x, y), canvas_tile, layer_key))
+
+    def tile_image_decoded(self, tile_key: tuple, canvas_tile: CanvasTile, layer_key: tuple, future: Future):
+        """ called by the decode pool when a tile image is decoded """
+
+        try:
+            image = future.result()
+        except PIL.UnidentifiedImageError:  # tile data is no image, don't request it again until the negative cache entry expires
+            tile_server = layer_key[0]
+            self.tile_service.tile_failures.record_missing((tile_server, *tile_key), TileSessionPool.get_server_key(tile_server))
+            self.tile_service.remove_tile(*tile_key, tile_server)
+            image = self.empty_tile_image
         except Exception:
-            return self.empty_tile_image
+            image = self.empty_tile_image
+        else:
+            # decoded tiles are the sources for the placeholders of the next zoom levels
+            self.placeholder_source_cache.put((*tile_key, layer_key), image, image.width * image.height * len(image.getbands()))
+
+        self.put_tile_load_result(tile_key, canvas_tile, image, layer_key)
+
+    def put_tile_load_result(self, tile_key: tuple, canvas_tile: CanvasTile, image, layer_key: tuple, placeholder: bool = False):
+        """ called from background threads, appends result and wakes up the main thread with a <<TileImagesLoaded>> event """
+
+        # result queue structure: [((zoom, x, y), corresponding canvas tile object, tile image, time of result, layer_key, placeholder), ... ]
+        self.image_load_queue_results.append((tile_key, canvas_tile, image, time.perf_counter(), layer_key, placeholder))
+        self.result_statistics["max_queue_depth"] = max(self.result_statistics["max_queue_depth"], len(self.image_load_queue_results))
+
+        # only one event at a time, update_canvas_tile_images applies all results that are there,
+        # after a failed event the results are only picked up by check_tile_load_results, because every try blocks the thread for a second
+        with self.results_signal_lock:
+            if self.results_signal_pending or self.results_signal_failed or not self.running:
+                return
+            self.results_signal_pending = True
+
+        try:
+            self.event_generate("<<TileImagesLoaded>>", when="tail")
+        except (RuntimeError, tkinter.TclError):
+            # mainloop not running or widget destroyed, the results get applied by check_tile_load_results
+            with self.results_signal_lock:
+                self.results_signal_pending = False
+                self.results_signal_failed = True
+
+    def tile_refreshed(self, zoom: int, x: int, y: int, server: str):
+        """ called by the tile service when a tile changed on the server, the new tile gets loaded on the next draw """
+
+        self.tile_image_cache.remove_matching(lambda key: key[:3] == (zoom, x, y))
+
+    def refresh_stale_tiles(self):
+        """ revalidate all expired tiles of the current tile server in the database in the background,
+            needs persistent_tile_cache=True """
+
+        self.tile_service.refresh_stale_tiles(self.tile_server)
+
+    def get_tile_statistics(self) -> dict:
+        """ returns counters of the tile loading pipeline, the counters of the tile service include the tasks of all widgets
+            that share it, except for queued_tasks """
+
+        applied_results = self.result_statistics["applied_results"]
+        return {**self.tile_service.get_statistics(),
+                "queued_tasks": len(self.image_load_queue_tasks),
+                "queued_results": len(self.image_load_queue_results),
+                "max_queued_results": self.result_statistics["max_queue_depth"],
+                "applied_results": applied_results,
+                "average_apply_latency": self.result_statistics["total_apply_latency"] / applied_results if applied_results > 0 else 0.0,
+                "max_apply_latency": self.result_statistics["max_apply_latency"],
+                "last_update_duration": self.result_statistics["last_update_duration"],
+                "memory_cache": self.tile_image_cache.get_statistics()}
 
     def get_tile_image_from_cache(self, zoom: int, x: int, y: int):
-        if f"{zoom}{x}{y}" not in self.tile_image_cache:
-            return False
-        else:
-            return self.tile_image_cache[f"{zoom}{x}{y}"]
+        return self.tile_image_cache.get((zoom, x, y, self.layer_key), default=False)
 
-    def load_images_background(self):
-        if self.database_path is not None:
-            db_connection = sqlite3.connect(self.database_path)
-            db_cursor = db_connection.cursor()
-        else:
-            db_cursor = None
+    def get_placeholder_source_cache_size(self) -> int:
+        """ memory for the decoded tiles of the visible area and a margin of one tile, of the current and the last zoom level """
 
-        while self.running:
-            if len(self.image_load_queue_tasks) > 0:
-                # task queue structure: [((zoom, x, y), corresponding canvas tile object), ... ]
-                task = self.image_load_queue_tasks.pop()
+        number_of_tiles = (math.ceil(self.width / self.tile_size) + 2) * (math.ceil(self.height / self.tile_size) + 2)
+        return 2 * number_of_tiles * self.tile_size ** 2 * 4
 
-                zoom = task[0][0]
-                x, y = task[0][1], task[0][2]
-                canvas_tile = task[1]
+    def get_placeholder_source(self, zoom: int, x: int, y: int, layer_key: tuple) -> Union[Image.Image, bytes, None]:
+        """ decoded image of a recently loaded tile, or its encoded tile data if it's only in the tile data cache, None if it's not there """
 
-                image = self.get_tile_image_from_cache(zoom, x, y)
-                if image is False:
-                    image = self.request_image(zoom, x, y, db_cursor=db_cursor)
-                    if image is None:
-                        self.image_load_queue_tasks.append(task)
-                        continue
+        image = self.placeholder_source_cache.get((zoom, x, y, layer_key))
+        if image is not None:
+            return image
+        return self.tile_service.tile_data_cache.get((layer_key[0], zoom, x, y))
 
-                # result queue structure: [((zoom, x, y), corresponding canvas tile object, tile image), ... ]
-                self.image_load_queue_results.append(((zoom, x, y), canvas_tile, image))
+    def get_placeholder_tile_image(self, zoom: int, x: int, y: int) -> ImageTk.PhotoImage:
+        """ placeholder for a tile which is not loaded yet if it was already built, otherwise not_loaded_tile_image """
 
-            else:
-                time.sleep(0.01)
+        return self.placeholder_image_cache.get((zoom, x, y, self.layer_key), default=self.not_loaded_tile_image)
 
-    def update_canvas_tile_images(self):
+    def request_placeholder_image(self, canvas_tile: CanvasTile):
+        """ build the placeholder of a canvas tile without image in the decode pool: the scaled up part of a cached ancestor tile
+            or the scaled down cached child tiles, it gets shown by update_canvas_tile_images if the tile is not loaded until then """
+
+        if canvas_tile.image is not self.not_loaded_tile_image:
+            return
+
+        zoom = round(self.zoom)
+        x, y = canvas_tile.tile_name_position
+        layer_key = self.layer_key
+        if (zoom, x, y, layer_key) in self.placeholder_requests:
+            return
+
+        # search ancestor tiles up to three zoom levels above
+        ancestor, zoom_difference = None, 0
+        for zoom_difference in range(1, min(3, zoom) + 1):
+            ancestor = self.get_placeholder_source(zoom - zoom_difference, x >> zoom_difference, y >> zoom_difference, layer_key)
+            if ancestor is not None:
+                break
+
+        # combine child tiles one zoom level below
+        children = {}
+        if ancestor is None and zoom < self.max_zoom:
+            for child_x in (0, 1):
+                for child_y in (0, 1):
+                    child = self.get_placeholder_source(zoom + 1, 2 * x + child_x, 2 * y + child_y, layer_key)
+                    if child is not None:
+                        children[(child_x, child_y)] = child
+
+        if ancestor is None and len(children) == 0:
+            return
+
+        try:
+            future = self.tile_service.decode_executor.submit(decode_placeholder_image, self.tile_size, ancestor, zoom_difference, x, y,
+                                                              children, (241, 239, 234))
+        except RuntimeError:  # decode pool is shut down, because the widget got destroyed
+            return
+        self.placeholder_requests.add((zoom, x, y, layer_key))
+        future.add_done_callback(partial(self.placeholder_image_decoded, (zoom, x, y), canvas_tile, layer_key))
+
+    def placeholder_image_decoded(self, tile_key: tuple, canvas_tile: CanvasTile, layer_key: tuple, future: Future):
+        """ called by the decode pool when a placeholder is built """
+
+        self.placeholder_requests.discard((*tile_key, layer_key))
+        try:
+            image = future.result()
+        except Exception:
+            return
+
+        self.put_tile_load_result(tile_key, canvas_tile, image, layer_key, placeholder=True)
+
+    def is_tile_visible(self, tile_key: tuple) -> bool:
+        """ True if the tile is on the map, with the current tile server and layer combination if tile_key contains a layer_key """
+
+        zoom, x, y = tile_key[:3]
+        return zoom == round(self.zoom) and tile_key[3:] in ((), (self.layer_key,)) and \
+            math.floor(self.upper_left_tile_pos[0]) <= x <= math.ceil(self.lower_right_tile_pos[0]) and \
+            math.floor(self.upper_left_tile_pos[1]) <= y <= math.ceil(self.lower_right_tile_pos[1])
+
+    def load_tile(self, task: tuple, tile_table: TileTable = None):
+        """ called by a loader thread of the tile service for a task of this widget,
+            task structure: ((zoom, x, y), corresponding canvas tile object or None, [rank in prefetch plan]) """
+
+        if not self.running:
+            return
+
+        zoom = task[0][0]
+        x, y = task[0][1], task[0][2]
+        canvas_tile = task[1]
+
+        # pre-cache tasks only load the encoded tile data, it gets decoded when the tile becomes visible
+        if canvas_tile is None:
+            tile_server, overlay_layers = self.layer_key
+            for server in (tile_server, *(server for server, opacity in overlay_layers)):
+                # no need to wait for a tile that is already loaded by another thread
+                if not self.tile_service.in_flight_requests.is_in_flight((server, zoom, x, y)):
+                    self.tile_service.request_tile_data(server, zoom, x, y, tile_table=tile_table)
+            return
+
+        layer_key = self.layer_key
+        image = self.tile_image_cache.get((zoom, x, y, layer_key), default=False)
+        if image is False:
+            self.request_image(zoom, x, y, canvas_tile, tile_table=tile_table)
+        else:
+            self.put_tile_load_result((zoom, x, y), canvas_tile, image, layer_key)
+
+    def check_tile_load_results(self):
+        """ fallback in the main thread for results without <<TileImagesLoaded>> event, for example if the application calls update()
+            in its own loop instead of mainloop(), checks every 10 ms after a failed event and every 100 ms otherwise """
+
+        if not self.running:
+            return
+
+        if len(self.image_load_queue_results) > 0 and (self.results_signal_failed or not self.results_signal_pending):
+            self.update_canvas_tile_images()
+        self.after(10 if self.results_signal_failed else 100, self.check_tile_load_results)
+
+    def update_canvas_tile_images(self, event=None):
+        with self.results_signal_lock:
+            self.results_signal_pending = False
+
+        start_time = time.perf_counter()
 
         while len(self.image_load_queue_results) > 0 and self.running:
-            # result queue structure: [((zoom, x, y), corresponding canvas tile object, tile image), ... ]
-            result = self.image_load_queue_results.pop(0)
+            # result queue structure: [((zoom, x, y), corresponding canvas tile object, tile image, time of result, layer_key, placeholder), ... ]
+            result = self.image_load_queue_results.popleft()
 
             zoom, x, y = result[0][0], result[0][1], result[0][2]
             canvas_tile = result[1]
             image = result[2]
+            layer_key = result[4]
+
+            apply_latency = time.perf_counter() - result[3]
+            self.result_statistics["applied_results"] += 1
+            self.result_statistics["total_apply_latency"] += apply_latency
+            self.result_statistics["max_apply_latency"] = max(self.result_statistics["max_apply_latency"], apply_latency)
 
             # check if zoom level of result is still up to date, otherwise don't update image
-            if zoom == round(self.zoom):
-                canvas_tile.set_image(image)
+            if zoom == round(self.zoom) and result[5]:
+                # placeholders are only shown if the canvas tile still waits for the image of this tile
+                placeholder = ImageTk.PhotoImage(image)
+                self.placeholder_image_cache.put((zoom, x, y, layer_key), placeholder, image.width * image.height * 4)
+                if layer_key == self.layer_key and canvas_tile.tile_name_position == (x, y) and canvas_tile.image is self.not_loaded_tile_image:
+                    canvas_tile.set_image(placeholder)
+
+            elif zoom == round(self.zoom):
+                # decoded images get converted to PhotoImages here, because tkinter objects are not thread-safe
+                if isinstance(image, Image.Image):
+                    decoded_image = image
+                    image = ImageTk.PhotoImage(decoded_image)
+                    self.tile_image_cache.put((zoom, x, y, layer_key), image, decoded_image.width * decoded_image.height * 4)
+
+                # images of a layer combination that changed in the meantime are only cached
+                if layer_key == self.layer_key:
+                    canvas_tile.set_image(image)
+
+            # leave the remaining results for the next update, so that the map stays responsive
+            if (time.perf_counter() - start_time) * 1000 > self.frame_time_budget:
+                break
 
-        # This function calls itself every 10 ms with tk.after() so that the image updates come
-        # from the main GUI thread, because tkinter can only be updated from the main thread.
-        if self.running:
-            self.after(10, self.update_canvas_tile_images)
+        self.result_statistics["last_update_duration"] = time.perf_counter() - start_time
+
+        # This function gets called from the main GUI thread by the <<TileImagesLoaded>> event, because tkinter can only
+        # be updated from the main thread. If the time budget is used up, the remaining results follow in the next frame.
+        if self.running and len(self.image_load_queue_results) > 0:
+            self.after(1, self.update_canvas_tile_images)
 
     def insert_row(self, insert: int, y_name_position: int):
 
@@ -604,8 +896,9 @@ class TkinterMapView(tkinter.Frame):
 
             image = self.get_tile_image_from_cache(round(self.zoom), *tile_name_position)
             if image is False:
-                canvas_tile = CanvasTile(self, self.not_loaded_tile_image, tile_name_position)
-                self.image_load_queue_tasks.append(((round(self.zoom), *tile_name_position), canvas_tile))
+                canvas_tile = CanvasTile(self, self.get_placeholder_tile_image(round(self.zoom), *tile_name_position), tile_name_position)
+                self.request_placeholder_image(canvas_tile)
+                self.image_load_queue_tasks.put(((round(self.zoom), *tile_name_position), canvas_tile))
             else:
                 canvas_tile = CanvasTile(self, image, tile_name_position)
 
@@ -622,8 +915,9 @@ class TkinterMapView(tkinter.Frame):
             image = self.get_tile_image_from_cache(round(self.zoom), *tile_name_position)
             if image is False:
                 # image is not in image cache, load blank tile and append position to image_load_queue
-                canvas_tile = CanvasTile(self, self.not_loaded_tile_image, tile_name_position)
-                self.image_load_queue_tasks.append(((round(self.zoom), *tile_name_position), canvas_tile))
+                canvas_tile = CanvasTile(self, self.get_placeholder_tile_image(round(self.zoom), *tile_name_position), tile_name_position)
+                self.request_placeholder_image(canvas_tile)
+                self.image_load_queue_tasks.put(((round(self.zoom), *tile_name_position), canvas_tile))
             else:
                 # image is already in cache
                 canvas_tile = CanvasTile(self, image, tile_name_position)
@@ -635,7 +929,7 @@ class TkinterMapView(tkinter.Frame):
         self.canvas_tile_array.insert(insert, canvas_tile_column)
 
     def draw_initial_array(self):
-        self.image_load_queue_tasks = []
+        self.image_load_queue_tasks.clear()
 
         x_tile_range = math.ceil(self.lower_right_tile_pos[0]) - math.floor(self.upper_left_tile_pos[0])
         y_tile_range = math.ceil(self.lower_right_tile_pos[1]) - math.floor(self.upper_left_tile_pos[1])
@@ -660,8 +954,9 @@ class TkinterMapView(tkinter.Frame):
                 image = self.get_tile_image_from_cache(round(self.zoom), *tile_name_position)
                 if image is False:
                     # image is not in image cache, load blank tile and append position to image_load_queue
-                    canvas_tile = CanvasTile(self, self.not_loaded_tile_image, tile_name_position)
-                    self.image_load_queue_tasks.append(((round(self.zoom), *tile_name_position), canvas_tile))
+                    canvas_tile = CanvasTile(self, self.get_placeholder_tile_image(round(self.zoom), *tile_name_position), tile_name_position)
+                    self.request_placeholder_image(canvas_tile)
+                    self.image_load_queue_tasks.put(((round(self.zoom), *tile_name_position), canvas_tile))
                 else:
                     # image is already in cache
                     canvas_tile = CanvasTile(self, image, tile_name_position)
@@ -684,8 +979,7 @@ class TkinterMapView(tkinter.Frame):
             polygon.draw()
 
         # update pre-cache position
-        self.pre_cache_position = (round((self.upper_left_tile_pos[0] + self.lower_right_tile_pos[0]) / 2),
-                                   round((self.upper_left_tile_pos[1] + self.lower_right_tile_pos[1]) / 2))
+        self.update_pre_cache_position()
 
     def draw_move(self, called_after_zoom: bool = False):
 
@@ -759,14 +1053,13 @@ class TkinterMapView(tkinter.Frame):
                 polygon.draw(move=not called_after_zoom)
 
             # update pre-cache position
-            self.pre_cache_position = (round((self.upper_left_tile_pos[0] + self.lower_right_tile_pos[0]) / 2),
-                                       round((self.upper_left_tile_pos[1] + self.lower_right_tile_pos[1]) / 2))
+            self.update_pre_cache_position()
 
     def draw_zoom(self):
 
         if self.canvas_tile_array:
             # clear tile image loading queue, so that no old images from other zoom levels get displayed
-            self.image_load_queue_tasks = []
+            self.image_load_queue_tasks.clear()
 
             # upper left tile name position
             upper_left_x = math.floor(self.upper_left_tile_pos[0])
@@ -779,14 +1072,14 @@ class TkinterMapView(tkinter.Frame):
 
                     image = self.get_tile_image_from_cache(round(self.zoom), *tile_name_position)
                     if image is False:
-                        image = self.not_loaded_tile_image
+                        image = self.get_placeholder_tile_image(round(self.zoom), *tile_name_position)
                         # noinspection PyCompatibility
-                        self.image_load_queue_tasks.append(((round(self.zoom), *tile_name_position), self.canvas_tile_array[x_pos][y_pos]))
+                        self.image_load_queue_tasks.put(((round(self.zoom), *tile_name_position), self.canvas_tile_array[x_pos][y_pos]))
 
                     self.canvas_tile_array[x_pos][y_pos].set_image_and_position(image, tile_name_position)
+                    self.request_placeholder_image(self.canvas_tile_array[x_pos][y_pos])
 
-            self.pre_cache_position = (round((self.upper_left_tile_pos[0] + self.lower_right_tile_pos[0]) / 2),
-                                       round((self.upper_left_tile_pos[1] + self.lower_right_tile_pos[1]) / 2))
+            self.update_pre_cache_position()
 
             self.draw_move(called_after_zoom=True)
 
@@ -922,6 +1215,10 @@ class TkinterMapView(tkinter.Frame):
         else:
             new_zoom = self.zoom + event.delta * 0.1
 
+        if new_zoom != self.zoom:
+            self.last_zoom_direction = 1 if new_zoom > self.zoom else -1
+            self.last_zoom_direction_time = time.time()
+
         self.set_zoom(new_zoom, relative_pointer_x=relative_mouse_x, relative_pointer_y=relative_mouse_y)
 
     def check_map_border_crossing(self):
@@ -0,0 +1,165 @@
+import sqlite3
+import threading
+from typing import Dict, Union
+
+from .tile_database import create_tables, TileTable
+
+# tile server url of an MBTiles file, for example "mbtiles:///home/user/berlin.mbtiles"
+MBTILES_SCHEME = "mbtiles://"
+
+
+def get_mbtiles_path(tile_server: str) -> Union[str, None]:
+    """ returns the file path if tile_server is an mbtiles:// url, otherwise None """
+
+    if tile_server.startswith(MBTILES_SCHEME):
+        return tile_server[len(MBTILES_SCHEME):]
+    return None
+
+
+def flip_y(zoom: int, y: int) -> int:
+    """ MBTiles uses the TMS tile scheme, which counts rows from the bottom, the flip is its own inverse """
+
+    return (1 << zoom) - 1 - y
+
+
+def get_tile_format(tile_data: bytes) -> str:
+    if tile_data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    elif tile_data[:3] == b"\xff\xd8\xff":
+        return "jpg"
+    elif tile_data[:4] == b"RIFF" and tile_data[8:12] == b"WEBP":
+        return "webp"
+    else:
+        return "pbf"
+
+
+def create_mbtiles_tables(db_cursor: sqlite3.Cursor):
+    """ create tables of an MBTiles file if they not exist """
+
+    db_cursor.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);")
+    db_cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS name ON metadata (name);")
+    db_cursor.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);")
+    db_cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row);")
+
+
+class MBTilesSource:
+    """ read-only access to the tiles of an MBTiles file, every thread gets its own connection with memory mapped I/O,
+        tiles are requested with the y coordinate of the map (XYZ scheme) """
+
+    def __init__(self, path: str, mmap_size: int = 256 * 1024 ** 2):
+        self.path = path
+        self.mmap_size = mmap_size
+
+        self.thread_data = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def get_cursor(self) -> sqlite3.Cursor:
+        db_cursor = getattr(self.thread_data, "db_cursor", None)
+        if db_cursor is None:
+            db_connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+            db_cursor = db_connection.cursor()
+            db_cursor.execute(f"PRAGMA mmap_size={self.mmap_size};")
+            db_cursor.execute("PRAGMA query_only=ON;")
+            self.thread_data.db_cursor = db_cursor
+            with self.lock:
+                self.connections.append(db_connection)
+        return db_cursor
+
+    def get_tile(self, zoom: int, x: int, y: int) -> Union[bytes, None]:
+        db_cursor = self.get_cursor()
+        db_cursor.execute("SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?;", (zoom, x, flip_y(zoom, y)))
+        result = db_cursor.fetchone()
+        return result[0] if result is not None else None
+
+    def get_metadata(self) -> Dict[str, str]:
+        db_cursor = self.get_cursor()
+        db_cursor.execute("SELECT name, value FROM metadata;")
+        return dict(db_cursor.fetchall())
+
+    def close(self):
+        with self.lock:
+            for db_connection in self.connections:
+                db_connection.close()
+            self.connections.clear()
+        self.thread_data = threading.local()
+
+
+def export_mbtiles(database_path: str, mbtiles_path: str, tile_server: str, name: str = None, batch_size: int = 1000) -> int:
+    """ copy all tiles of tile_server from an offline tile database to an MBTiles file, the tile data is copied without decoding,
+        returns the number of copied tiles """
+
+    source_connection = sqlite3.connect(f"file:{database_path}?mode=ro", uri=True)
+    source_cursor = source_connection.cursor()
+    target_connection = sqlite3.connect(mbtiles_path)
+    target_cursor = target_connection.cursor()
+    target_cursor.execute("PRAGMA synchronous=OFF;")  # a failed export is started again anyway
+    create_mbtiles_tables(target_cursor)
+
+    source_cursor.execute("SELECT zoom, x, y, tile_image FROM tiles WHERE server=?;", (tile_server,))
+    number_of_tiles = 0
+    tile_format, min_zoom, max_zoom = None, None, None
+
+    # stream the tiles in batches, one transaction per batch
+    while True:
+        rows = source_cursor.fetchmany(batch_size)
+        if len(rows) == 0:
+            break
+
+        target_cursor.executemany("INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?);",
+                                  [(zoom, x, flip_y(zoom, y), tile_image) for zoom, x, y, tile_image in rows])
+        target_connection.commit()
+
+        if tile_format is None:
+            tile_format = get_tile_format(rows[0][3])
+        batch_min_zoom, batch_max_zoom = min(row[0] for row in rows), max(row[0] for row in rows)
+        min_zoom = batch_min_zoom if min_zoom is None else min(min_zoom, batch_min_zoom)
+        max_zoom = batch_max_zoom if max_zoom is None else max(max_zoom, batch_max_zoom)
+        number_of_tiles += len(rows)
+
+    metadata = {"name": name if name is not None else tile_server,
+                "format": tile_format if tile_format is not None else "png",
+                "type": "baselayer",
+                "version": "1.1"}
+    if min_zoom is not None:
+        metadata.update({"minzoom": str(min_zoom), "maxzoom": str(max_zoom)})
+    target_cursor.executemany("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?);", metadata.items())
+    target_connection.commit()
+
+    source_connection.close()
+    target_connection.close()
+    return number_of_tiles
+
+
+def import_mbtiles(mbtiles_path: str, database_path: str, tile_server: str, batch_size: int = 1000) -> int:
+    """ copy all tiles of an MBTiles file to an offline tile database under the name tile_server,
+        existing tiles are replaced, the tile data is copied without decoding, returns the number of copied tiles """
+
+    source_connection = sqlite3.connect(f"file:{mbtiles_path}?mode=ro", uri=True)
+    source_cursor = source_connection.cursor()
+    target_connection = sqlite3.connect(database_path, timeout=30)
+    target_cursor = target_connection.cursor()
+    create_tables(target_cursor)
+    tile_table = TileTable(target_cursor)
+
+    source_cursor.execute("SELECT MAX(zoom_level) FROM tiles;")
+    max_zoom = source_cursor.fetchone()[0]
+    target_cursor.execute("INSERT OR IGNORE INTO server (url, max_zoom) VALUES (?, ?);", (tile_server, max_zoom if max_zoom is not None else 19))
+    target_connection.commit()
+
+    source_cursor.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles;")
+    number_of_tiles = 0
+
+    # stream the tiles in batches, one transaction per batch
+    while True:
+        rows = source_cursor.fetchmany(batch_size)
+        if len(rows) == 0:
+            break
+
+        tile_table.insert_tiles([(zoom, x, flip_y(zoom, y), tile_server, tile_data) for zoom, x, y, tile_data in rows], replace=True)
+        target_connection.commit()
+        number_of_tiles += len(rows)
+
+    source_connection.close()
+    target_connection.close()
+    return number_of_tiles
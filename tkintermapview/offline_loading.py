@@ -2,16 +2,26 @@ import os
 import time
 import sqlite3
 import threading
-import requests
 import sys
 import math
-from PIL import Image, UnidentifiedImageError
+import heapq
+import ast
+import collections
+import hashlib
+import json
+from typing import Callable, Union
 
-from .utility_functions import decimal_to_osm, osm_to_decimal
+from .tile_coverage import Coverage, get_rectangle_coverage, get_polygon_coverage, get_path_coverage, get_tile_list_coverage
+from .tile_session import TileSessionPool, get_default_session_pool, get_expiry_time, is_image_response
+from .tile_database import create_tables, TileDatabaseWriter, TileTable, LAYOUT_DEFAULT, LAYOUT_DEDUPLICATED
+from .tile_refresh import TileRefresher
+from .tile_failures import TileFailureTracker
+from .tile_url import TileUrlTemplate
 
 
 class OfflineLoader:
-    def __init__(self, path=None, tile_server=None, max_zoom=19):
+    def __init__(self, path=None, tile_server=None, max_zoom=19, session_pool: TileSessionPool = None, default_tile_ttl: float = 7 * 24 * 60 * 60,
+                 subdomains: str = "abc", deduplicate: bool = False, layout: str = None):
         if path is None:
             self.db_path = os.path.join(os.path.abspath(os.getcwd()), "offline_tiles.db")
         else:
@@ -21,15 +31,41 @@ class OfflineLoader:
             self.tile_server = "https://a.tile.openstreetmap.org/{z}/{x}/{y}.png"
         else:
             self.tile_server = tile_server
+        self.tile_url_template = TileUrlTemplate(self.tile_server, subdomains)  # subdomains for the {s} placeholder
 
         self.max_zoom = max_zoom
+        self.session_pool = session_pool if session_pool is not None else get_default_session_pool()
+        self.default_tile_ttl = default_tile_ttl  # seconds until a tile expires, if the server sends no caching headers
+        # storage layout of new databases: "default", "deduplicated" (identical tiles are stored only once) or "v2" (schema version 2)
+        if layout is not None:
+            self.layout = layout
+        else:
+            self.layout = LAYOUT_DEDUPLICATED if deduplicate else LAYOUT_DEFAULT
 
-        self.task_queue = []
-        self.result_queue = []
+        self.task_queue = []  # tasks are (zoom, x, y, generation)
+        self.result_queue = []  # (zoom, x, y, server, stored, given_up) of every finished task
+        self.retry_queue = []  # heap of (retry time, task), failed tasks wait here until their backoff time is over
         self.thread_pool = []
         self.lock = threading.Lock()
         self.number_of_threads = 50
 
+        # every download gets a new generation, results of tasks from an interrupted download are dropped
+        self.generation = 0
+        self.number_of_running_tasks = 0
+
+        # failed tiles are retried with exponential backoff, at most max_attempts times
+        self.failure_tracker = TileFailureTracker()
+        self.max_attempts = 8
+
+        # downloaded tiles are written by a single writer thread in batched transactions,
+        # the download threads block when write_queue_size tiles are waiting to be written
+        self.database_writer = None
+        self.write_batch_size = 1000
+        self.write_queue_size = 2000
+
+        # seconds between checkpoints of a download job, an interrupted download continues from its last checkpoint
+        self.checkpoint_interval = 5.0
+
     def print_loaded_sections(self):
         # connect to database
         db_connection = sqlite3.connect(self.db_path)
@@ -43,99 +79,220 @@ class OfflineLoader:
 
         print("", end="\n\n")
 
+    def refresh_stale_tiles(self, number_of_threads: int = 8):
+        """ revalidate all expired tiles of the tile server in the database with conditional requests,
+            unchanged tiles only cost a 304 response, changed tiles are downloaded again """
+
+        db_connection = sqlite3.connect(self.db_path)
+        create_tables(db_connection.cursor())
+        db_connection.commit()
+        db_connection.close()
+
+        database_writer = TileDatabaseWriter(self.db_path)
+        tile_refresher = TileRefresher(self.db_path, self.session_pool, database_writer,
+                                       default_ttl=self.default_tile_ttl, number_of_threads=number_of_threads,
+                                       url_templates={self.tile_server: self.tile_url_template})
+
+        print("[refresh_stale_tiles] revalidating expired tiles ...")
+        tile_refresher.refresh_stale_tiles(self.tile_server, blocking=True)
+        tile_refresher.close()
+        database_writer.close()
+
+        print(f"[refresh_stale_tiles] not modified: {tile_refresher.number_of_not_modified_tiles}  "
+              f"replaced: {tile_refresher.number_of_replaced_tiles}  failed: {tile_refresher.number_of_failed_tiles}", end="\n\n")
+
+    def retry_task_later(self, task, count_failure: bool = True):
+        """ put a failed task into the retry queue until its backoff time is over, after max_attempts the tile is skipped """
+
+        tile_key = (self.tile_server, *task[:3])
+        server_key = TileSessionPool.get_server_key(self.tile_server)
+
+        if not count_failure:
+            # server is unavailable or the tile waits for its backoff, retry when a request is allowed again
+            retry_time = self.failure_tracker.get_retry_time(tile_key, server_key)
+        elif self.failure_tracker.get_number_of_failures(tile_key) + 1 >= self.max_attempts:
+            self.failure_tracker.record_failure(tile_key, server_key)
+            sys.stderr.write(f"[save_offline_tiles] giving up tile {task[:3]} after {self.max_attempts} attempts\n")
+            self.add_result(task, False, given_up=True)
+            return
+        else:
+            retry_time = time.time() + self.failure_tracker.record_failure(tile_key, server_key)
+
+        self.lock.acquire()
+        if task[3] == self.generation:
+            heapq.heappush(self.retry_queue, (retry_time, task))
+        self.lock.release()
+
+    def add_result(self, task, stored: bool, given_up: bool = False):
+        """ report a finished task, unless it belongs to an interrupted download """
+
+        self.lock.acquire()
+        if task[3] == self.generation:
+            self.result_queue.append((*task[:3], self.tile_server, stored, given_up))
+        self.lock.release()
+
     def save_offline_tiles_thread(self):
-        db_connection = sqlite3.connect(self.db_path, timeout=10)
-        db_cursor = db_connection.cursor()
+        server_key = TileSessionPool.get_server_key(self.tile_server)
 
         while True:
             self.lock.acquire()
-            if len(self.task_queue) > 0:
+            if len(self.retry_queue) > 0 and self.retry_queue[0][0] <= time.time():
+                task = heapq.heappop(self.retry_queue)[1]
+            elif len(self.task_queue) > 0:
                 task = self.task_queue.pop()
-                self.lock.release()
-                zoom, x, y = task[0], task[1], task[2]
+            else:
+                task = None
 
-                check_existence_cmd = f"""SELECT t.zoom, t.x, t.y FROM tiles t WHERE t.zoom=? AND t.x=? AND t.y=? AND server=?;"""
+            if task is not None:
+                self.number_of_running_tasks += 1
+                self.lock.release()
                 try:
-                    db_cursor.execute(check_existence_cmd, (zoom, x, y, self.tile_server))
-                except sqlite3.OperationalError:
+                    self.save_offline_tile(task, server_key)
+                finally:
                     self.lock.acquire()
-                    self.task_queue.append(task)
-                    self.lock.release()
-                    continue
-
-                result = db_cursor.fetchall()
-                if len(result) == 0:
-
-                    try:
-                        url = self.tile_server.replace("{x}", str(x)).replace("{y}", str(y)).replace("{z}", str(zoom))
-                        image_data = requests.get(url, stream=True, headers={"User-Agent": "TkinterMapView"}).content
-
-                        self.lock.acquire()
-                        self.result_queue.append((zoom, x, y, self.tile_server, image_data))
-                        self.lock.release()
-
-                    except sqlite3.OperationalError:
-                        self.lock.acquire()
-                        self.task_queue.append(task)  # re-append task to task_queue
-                        self.lock.release()
-
-                    except UnidentifiedImageError:
-                        self.lock.acquire()
-                        self.result_queue.append((zoom, x, y, self.tile_server, None))
-                        self.lock.release()
-
-                    except Exception as err:
-                        sys.stderr.write(str(err) + "\n")
-                        self.lock.acquire()
-                        self.task_queue.append(task)
-                        self.lock.release()
-                else:
-                    self.lock.acquire()
-                    self.result_queue.append((zoom, x, y, self.tile_server, None))
+                    self.number_of_running_tasks -= 1
                     self.lock.release()
             else:
                 self.lock.release()
 
             time.sleep(0.01)
 
+    def save_offline_tile(self, task, server_key: str):
+        """ download one tile and hand it to the database writer """
+
+        zoom, x, y = task[0], task[1], task[2]
+
+        # tiles in the negative cache are not requested again, they are finished as missing
+        if self.failure_tracker.is_tile_missing((self.tile_server, zoom, x, y)):
+            self.add_result(task, False)
+            return
+
+        # only missing tiles are in the task queue, see save_zoom_level
+        if not self.failure_tracker.is_request_allowed((self.tile_server, zoom, x, y), server_key):
+            self.retry_task_later(task, count_failure=False)
+            return
+
+        try:
+            url = self.tile_url_template.get_url(zoom, x, y)
+            response = self.session_pool.get(url, throttle_key=server_key)
+            image_data = response.content
+
+            if response.status_code == 200 and len(image_data) > 0 and not is_image_response(response.headers):
+                # error page with status 200
+                self.retry_task_later(task)
+
+            elif response.status_code == 200 and len(image_data) > 0:
+                self.failure_tracker.record_success((self.tile_server, zoom, x, y), server_key)
+                validation = (response.headers.get("ETag"), response.headers.get("Last-Modified"),
+                              get_expiry_time(response.headers, self.default_tile_ttl))
+                self.database_writer.insert_tile(zoom, x, y, self.tile_server, image_data, validation=validation)
+                self.add_result(task, True)
+
+            elif response.status_code in (200, 204, 404, 410):
+                # tile does not exist on the server
+                self.failure_tracker.record_missing((self.tile_server, zoom, x, y), server_key)
+                self.add_result(task, False)
+
+            else:
+                self.retry_task_later(task)
+
+        except Exception as err:
+            sys.stderr.write(str(err) + "\n")
+            self.retry_task_later(task)
+
+    def save_checkpoint(self, job_id: int, zoom: int, checkpoint_x: int, completed: bool = False):
+        """ all tiles of the zoom level with x < checkpoint_x are finished, gets committed together with these tiles """
+
+        # tiles of a batch the writer could not write are lost, the download stops, so that no checkpoint skips them
+        if self.database_writer.error is not None:
+            raise self.database_writer.error
+
+        self.database_writer.execute("INSERT OR REPLACE INTO download_progress (job_id, zoom, checkpoint_x, completed) VALUES (?, ?, ?, ?);",
+                                     (job_id, zoom, checkpoint_x, int(completed)))
+
+    def resume_download_jobs(self):
+        """ continue all interrupted downloads of the tile server from their last checkpoint """
+
+        db_connection = sqlite3.connect(self.db_path)
+        db_cursor = db_connection.cursor()
+        create_tables(db_cursor)
+        db_connection.commit()
+
+        db_cursor.execute("""SELECT j.position_a, j.position_b, j.zoom_a, j.zoom_b, r.region FROM download_jobs j
+                             LEFT JOIN download_regions r ON r.job_id = j.job_id WHERE j.server=? AND j.completed=0 ORDER BY j.job_id;""",
+                          (self.tile_server,))
+        jobs = db_cursor.fetchall()
         db_connection.close()
 
+        for position_a, position_b, zoom_a, zoom_b, region in jobs:
+            if region is None:
+                self.save_offline_tiles(ast.literal_eval(position_a), ast.literal_eval(position_b), zoom_a, zoom_b)
+                continue
+
+            region = json.loads(region)
+            if region["type"] == "polygon":
+                self.save_offline_polygon(region["positions"], zoom_a, zoom_b)
+            elif region["type"] == "path":
+                self.save_offline_path(region["positions"], region["buffer_distance"], zoom_a, zoom_b)
+            elif region["type"] == "tiles":
+                self.save_offline_tile_list(region["tiles"])
+
     def save_offline_tiles(self, position_a, position_b, zoom_a, zoom_b):
+        """ download all tiles between position_a and position_b from zoom_a to zoom_b, the progress is checkpointed in the database,
+            so an interrupted download continues where it stopped, when it is started again with the same arguments """
+
+        self.save_offline_region(str(position_a), str(position_b), zoom_a, zoom_b, None,
+                                 lambda zoom: get_rectangle_coverage(position_a, position_b, zoom))
+
+    def save_offline_polygon(self, position_list: list, zoom_a: int, zoom_b: int):
+        """ download all tiles inside or touched by the polygon from zoom_a to zoom_b, position_list is a list of (lat, lon)
+            like for CanvasPolygon, the download is checkpointed like save_offline_tiles """
+
+        position_list = [(float(lat), float(lon)) for lat, lon in position_list]
+        region = {"type": "polygon", "positions": position_list}
+        self.save_offline_region("polygon", self.get_region_key(region), zoom_a, zoom_b, region,
+                                 lambda zoom: get_polygon_coverage(position_list, zoom))
+
+    def save_offline_path(self, position_list: list, buffer_distance: float, zoom_a: int, zoom_b: int):
+        """ download all tiles closer than buffer_distance (meters) to the path from zoom_a to zoom_b, position_list is a list of (lat, lon)
+            like for CanvasPath, the download is checkpointed like save_offline_tiles """
+
+        position_list = [(float(lat), float(lon)) for lat, lon in position_list]
+        region = {"type": "path", "positions": position_list, "buffer_distance": buffer_distance}
+        self.save_offline_region("path", self.get_region_key(region), zoom_a, zoom_b, region,
+                                 lambda zoom: get_path_coverage(position_list, buffer_distance, zoom))
+
+    def save_offline_tile_list(self, tile_list: list):
+        """ download all tiles of a list of (zoom, x, y), the download is checkpointed like save_offline_tiles """
+
+        tile_list = sorted(set((int(zoom), int(x), int(y)) for zoom, x, y in tile_list))
+        if len(tile_list) == 0:
+            return
+        region = {"type": "tiles", "tiles": tile_list}
+        self.save_offline_region("tiles", self.get_region_key(region), tile_list[0][0], tile_list[-1][0], region,
+                                 lambda zoom: get_tile_list_coverage(tile_list, zoom))
+
+    @staticmethod
+    def get_region_key(region: dict) -> str:
+        """ short hash of a region, used instead of position_b in the sections and download_jobs tables """
+
+        return hashlib.blake2b(json.dumps(region).encode(), digest_size=8).hexdigest()
+
+    def save_offline_region(self, position_a: str, position_b: str, zoom_a: int, zoom_b: int, region: Union[dict, None],
+                            get_coverage: Callable[[int], Coverage]):
+        """ download all tiles of get_coverage(zoom) from zoom_a to zoom_b, the section is identified by position_a and position_b """
+
         # connect to database
         db_connection = sqlite3.connect(self.db_path)
         db_cursor = db_connection.cursor()
 
         # create tables if it not exists
-        create_server_table = """CREATE TABLE IF NOT EXISTS server (
-                                        url VARCHAR(300) PRIMARY KEY NOT NULL,
-                                        max_zoom INTEGER NOT NULL);"""
-
-        create_tiles_table = """CREATE TABLE IF NOT EXISTS tiles (
-                                        zoom INTEGER NOT NULL,
-                                        x INTEGER NOT NULL,
-                                        y INTEGER NOT NULL,
-                                        server VARCHAR(300) NOT NULL,
-                                        tile_image BLOB NOT NULL,
-                                        CONSTRAINT fk_server FOREIGN KEY (server) REFERENCES server (url),
-                                        CONSTRAINT pk_tiles PRIMARY KEY (zoom, x, y, server));"""
-
-        create_sections_table = """CREATE TABLE IF NOT EXISTS sections (
-                                            position_a VARCHAR(100) NOT NULL,
-                                            position_b VARCHAR(100) NOT NULL,
-                                            zoom_a INTEGER NOT NULL,
-                                            zoom_b INTEGER NOT NULL,
-                                            server VARCHAR(300) NOT NULL,
-                                            CONSTRAINT fk_server FOREIGN KEY (server) REFERENCES server (url),
-                                            CONSTRAINT pk_tiles PRIMARY KEY (position_a, position_b, zoom_a, zoom_b, server));"""
-
-        db_cursor.execute(create_server_table)
-        db_cursor.execute(create_tiles_table)
-        db_cursor.execute(create_sections_table)
+        create_tables(db_cursor, layout=self.layout)
         db_connection.commit()
 
         # check if section is already in database
-        db_cursor.execute("SELECT * FROM sections s WHERE s.position_a=? AND s.position_b=? AND s.zoom_a=? AND zoom_b=? AND server=?;",
-                          (str(position_b), str(position_b), zoom_a, zoom_b, self.tile_server))
+        section = (position_a, position_b, zoom_a, zoom_b, self.tile_server)
+        db_cursor.execute("SELECT * FROM sections s WHERE s.position_a=? AND s.position_b=? AND s.zoom_a=? AND zoom_b=? AND server=?;", section)
         if len(db_cursor.fetchall()) != 0:
             print("[save_offline_tiles] section is already in database", end="\n\n")
             db_connection.close()
@@ -147,62 +304,154 @@ class OfflineLoader:
             db_cursor.execute(f"INSERT INTO server (url, max_zoom) VALUES (?, ?);", (self.tile_server, self.max_zoom))
             db_connection.commit()
 
-        # create threads
-        for i in range(self.number_of_threads):
-            thread = threading.Thread(daemon=True, target=self.save_offline_tiles_thread, args=())
-            self.thread_pool.append(thread)
+        # continue an interrupted download of the same section, or start a new job
+        db_cursor.execute("""SELECT j.job_id FROM download_jobs j WHERE j.position_a=? AND j.position_b=? AND j.zoom_a=? AND j.zoom_b=?
+                             AND j.server=? AND j.completed=0;""", section)
+        result = db_cursor.fetchone()
+        if result is not None:
+            job_id = result[0]
+            print(f"[save_offline_tiles] resuming download job {job_id}")
+        else:
+            db_cursor.execute("INSERT INTO download_jobs (position_a, position_b, zoom_a, zoom_b, server, created) VALUES (?, ?, ?, ?, ?, ?);",
+                              (*section, time.time()))
+            job_id = db_cursor.lastrowid
+            if region is not None:
+                db_cursor.execute("INSERT OR REPLACE INTO download_regions (job_id, region) VALUES (?, ?);", (job_id, json.dumps(region)))
+            db_connection.commit()
 
-        # start threads
-        for thread in self.thread_pool:
-            thread.start()
+        db_cursor.execute("SELECT zoom, checkpoint_x, completed FROM download_progress WHERE job_id=?;", (job_id,))
+        progress = {zoom: (checkpoint_x, bool(completed)) for zoom, checkpoint_x, completed in db_cursor.fetchall()}
+
+        tile_table = TileTable(db_cursor)
+        self.database_writer = TileDatabaseWriter(self.db_path, batch_size=self.write_batch_size, max_queue_size=self.write_queue_size)
+
+        # create and start threads, they are reused by following downloads
+        if len(self.thread_pool) == 0:
+            for i in range(self.number_of_threads):
+                thread = threading.Thread(daemon=True, target=self.save_offline_tiles_thread, args=())
+                thread.start()
+                self.thread_pool.append(thread)
+
+        try:
+            # loop through all zoom levels
+            number_of_given_up_tiles = 0
+            for zoom in range(round(zoom_a), round(zoom_b + 1)):
+                checkpoint_x, completed = progress.get(zoom, (None, False))
+                if completed:
+                    print(f"[save_offline_tiles] zoom: {zoom:<2}  already completed")
+                    continue
+                number_of_given_up_tiles += self.save_zoom_level(tile_table, job_id, position_a, position_b, zoom, get_coverage(zoom), checkpoint_x)
 
-        # loop through all zoom levels
-        for zoom in range(round(zoom_a), round(zoom_b + 1)):
-            upper_left_tile_pos = decimal_to_osm(*position_a, zoom)
-            lower_right_tile_pos = decimal_to_osm(*position_b, zoom)
+            print("", end="\n\n")
 
-            self.lock.acquire()
-            for x in range(math.floor(upper_left_tile_pos[0]), math.ceil(lower_right_tile_pos[0]) + 1):
-                for y in range(math.floor(upper_left_tile_pos[1]), math.ceil(lower_right_tile_pos[1]) + 1):
-                    self.task_queue.append((zoom, x, y))
-            number_of_tasks = len(self.task_queue)
-            self.lock.release()
+            # the job stays unfinished, so that the given up tiles are retried when it is started again or resumed
+            if number_of_given_up_tiles > 0:
+                print(f"[save_offline_tiles] {number_of_given_up_tiles} tiles could not be loaded, start the download again to retry them",
+                      end="\n\n")
+                return
 
-            print(f"[save_offline_tiles] zoom: {zoom:<2}  tiles: {number_of_tasks:<8}  storage: {math.ceil(number_of_tasks * 8 / 1024):>6} MB", end="")
-            print(f"  progress: ", end="")
+            # insert loading section in database, after the writer confirmed that all tiles are committed
+            self.database_writer.flush()
+            self.database_writer.execute("INSERT OR IGNORE INTO sections (position_a, position_b, zoom_a, zoom_b, server) VALUES (?, ?, ?, ?, ?);",
+                                         section)
+            self.database_writer.execute("UPDATE download_jobs SET completed=1 WHERE job_id=?;", (job_id,))
 
-            result_counter = 0
-            loading_bar_length = 0
-            while result_counter < number_of_tasks:
+        finally:
+            # drop waiting tasks if the download was interrupted, results of tasks that are still running are dropped as well
+            self.lock.acquire()
+            self.task_queue.clear()
+            self.retry_queue.clear()
+            self.result_queue = []
+            self.generation += 1
+            self.lock.release()
 
+            # wait for the running tasks before the writer is closed, their tiles get written with the last checkpoint
+            while True:
                 self.lock.acquire()
-                if len(self.result_queue) > 0:
-                    loading_result = self.result_queue.pop()
-                    self.lock.release()
-                    result_counter += 1
-
-                    if loading_result[-1] is not None:
-                        insert_tile_cmd = """INSERT INTO tiles (zoom, x, y, server, tile_image) VALUES (?, ?, ?, ?, ?);"""
-                        db_cursor.execute(insert_tile_cmd, loading_result)
-                        db_connection.commit()
-                else:
-                    self.lock.release()
-
-                # update loading bar to current progress (percent)
-                percent = result_counter / number_of_tasks
-                length = round(percent * 30)
-                while length > loading_bar_length:
-                    print("█", end="")
-                    loading_bar_length += 1
-
-            print(f" {result_counter:>8} tiles loaded")
+                number_of_running_tasks = self.number_of_running_tasks
+                self.lock.release()
+                if number_of_running_tasks == 0:
+                    break
+                time.sleep(0.01)
 
-        print("", end="\n\n")
+            self.database_writer.close()
+            self.database_writer = None
+            db_connection.close()
 
-        # insert loading section in database
-        db_cursor.execute(f"INSERT INTO sections (position_a, position_b, zoom_a, zoom_b, server) VALUES (?, ?, ?, ?, ?);",
-                          (str(position_b), str(position_b), zoom_a, zoom_b, self.tile_server))
-        db_connection.commit()
+    def save_zoom_level(self, tile_table: TileTable, job_id: int, position_a: str, position_b: str, zoom: int, coverage: Coverage,
+                        checkpoint_x: Union[int, None]) -> int:
+        """ download the missing tiles of the coverage of one zoom level, beginning at checkpoint_x,
+            returns the number of tiles that were given up after max_attempts """
+
+        columns = [x for x in coverage if checkpoint_x is None or x >= checkpoint_x]
+
+        # only download tiles that are not in the database yet, one range query per y range of a column
+        missing_tasks = []
+        number_of_stored_tiles = 0
+        for x in columns:
+            for y_start, y_stop in coverage[x]:
+                stored_tiles = tile_table.get_stored_tiles(zoom, self.tile_server, range(x, x + 1), range(y_start, y_stop))
+                missing_tasks.extend((zoom, x, y, self.generation) for y in range(y_start, y_stop) if (x, y) not in stored_tiles)
+                number_of_stored_tiles += len(stored_tiles)
+        number_of_tasks = len(missing_tasks)
+        remaining_tasks_per_column = collections.Counter(task[1] for task in missing_tasks)
+        given_up_tiles_per_column = collections.Counter()
+
+        # tasks are taken from the end of the task queue, so the columns get finished in order of x
+        self.lock.acquire()
+        self.task_queue.extend(reversed(missing_tasks))
+        self.lock.release()
+
+        print(f"[save_offline_tiles] zoom: {zoom:<2}  tiles: {number_of_tasks:<8}  storage: {math.ceil(number_of_tasks * 8 / 1024):>6} MB", end="")
+        print(f"  progress: ", end="")
+
+        column_index = 0
+        last_checkpoint_time = time.time()
+        result_counter = 0
+        loading_bar_length = 0
+        while result_counter < number_of_tasks:
+
+            # the tiles are already handed to the database writer, only count the finished tasks
+            self.lock.acquire()
+            results, self.result_queue = self.result_queue, []
+            self.lock.release()
 
-        db_connection.close()
-        return
+            if len(results) == 0:
+                time.sleep(0.01)
+                continue
+            result_counter += len(results)
+
+            # advance the checkpoint over all columns without unfinished or given up tasks
+            for result in results:
+                remaining_tasks_per_column[result[1]] -= 1
+                if result[5]:
+                    given_up_tiles_per_column[result[1]] += 1
+            while (column_index < len(columns) and remaining_tasks_per_column[columns[column_index]] <= 0
+                   and given_up_tiles_per_column[columns[column_index]] == 0):
+                column_index += 1
+
+            if time.time() - last_checkpoint_time > self.checkpoint_interval and column_index < len(columns):
+                self.save_checkpoint(job_id, zoom, columns[column_index])
+                last_checkpoint_time = time.time()
+
+            # update loading bar to current progress (percent)
+            percent = result_counter / number_of_tasks
+            length = round(percent * 30)
+            while length > loading_bar_length:
+                print("█", end="")
+                loading_bar_length += 1
+
+        number_of_given_up_tiles = sum(given_up_tiles_per_column.values())
+        print(f" {result_counter - number_of_given_up_tiles:>8} tiles loaded  {number_of_stored_tiles:>8} already stored", end="")
+        print(f"  {number_of_given_up_tiles:>8} given up" if number_of_given_up_tiles > 0 else "")
+
+        # the checkpoint stays at the first column with a given up tile, the zoom level is not completed
+        if number_of_given_up_tiles > 0:
+            self.save_checkpoint(job_id, zoom, columns[column_index])
+            return number_of_given_up_tiles
+
+        # every zoom level gets its own section, so completed zoom levels of an unfinished download are visible in the database
+        self.save_checkpoint(job_id, zoom, columns[-1] + 1 if len(columns) > 0 else 0, completed=True)
+        self.database_writer.execute("INSERT OR IGNORE INTO sections (position_a, position_b, zoom_a, zoom_b, server) VALUES (?, ?, ?, ?, ?);",
+                                     (position_a, position_b, zoom, zoom, self.tile_server))
+        return 0
@@ -0,0 +1,82 @@
+import math
+from typing import List, Tuple
+
+
+class PrefetchPlanner:
+    """ plans which tiles around the viewport get prefetched: tiles along the extrapolated movement path come first,
+        and the next zoom level is included while the user is zooming
+
+        tile_budget: maximum number of tiles per plan
+        margin: number of tiles around the viewport and the movement path which get prefetched
+        look_ahead_time: seconds the movement gets extrapolated with the current velocity """
+
+    def __init__(self, tile_budget: int = 200, margin: int = 2, look_ahead_time: float = 1.0):
+        self.tile_budget = tile_budget
+        self.margin = margin
+        self.look_ahead_time = look_ahead_time
+
+    def plan(self,
+             upper_left_tile_pos: Tuple[float, float],
+             lower_right_tile_pos: Tuple[float, float],
+             zoom: int,
+             velocity: Tuple[float, float] = (0, 0),
+             zoom_direction: int = 0,
+             min_zoom: int = 0,
+             max_zoom: int = 19) -> List[Tuple[int, int, int]]:
+        """ returns (zoom, x, y) of the tiles to prefetch, most important first,
+            velocity is in tiles per second, zoom_direction is 1 when zooming in, -1 when zooming out, otherwise 0 """
+
+        number_of_tiles = 2 ** zoom
+        half_width = (lower_right_tile_pos[0] - upper_left_tile_pos[0]) / 2
+        half_height = (lower_right_tile_pos[1] - upper_left_tile_pos[1]) / 2
+        center_x, center_y = upper_left_tile_pos[0] + half_width, upper_left_tile_pos[1] + half_height
+
+        # extrapolated middle of the viewport, limited to three viewport sizes
+        move_x = max(-6 * half_width, min(6 * half_width, velocity[0] * self.look_ahead_time))
+        move_y = max(-6 * half_height, min(6 * half_height, velocity[1] * self.look_ahead_time))
+        path_length_squared = move_x ** 2 + move_y ** 2
+
+        visible_x = (math.floor(upper_left_tile_pos[0]), math.ceil(lower_right_tile_pos[0]))
+        visible_y = (math.floor(upper_left_tile_pos[1]), math.ceil(lower_right_tile_pos[1]))
+
+        # candidate area: viewport and extrapolated viewport with margin
+        x_range = range(max(0, math.floor(min(center_x, center_x + move_x) - half_width - self.margin)),
+                        min(number_of_tiles, math.ceil(max(center_x, center_x + move_x) + half_width + self.margin)))
+        y_range = range(max(0, math.floor(min(center_y, center_y + move_y) - half_height - self.margin)),
+                        min(number_of_tiles, math.ceil(max(center_y, center_y + move_y) + half_height + self.margin)))
+
+        scored_tiles = []
+        for x in x_range:
+            for y in y_range:
+                # visible tiles are loaded anyway
+                if visible_x[0] <= x < visible_x[1] and visible_y[0] <= y < visible_y[1]:
+                    continue
+
+                offset_x, offset_y = x + 0.5 - center_x, y + 0.5 - center_y
+
+                # position along the movement path (0: current middle, 1: extrapolated middle) and distance to the path
+                if path_length_squared > 0:
+                    path_position = max(0.0, min(1.0, (offset_x * move_x + offset_y * move_y) / path_length_squared))
+                else:
+                    path_position = 0.0
+                distance_x = abs(offset_x - path_position * move_x) - half_width
+                distance_y = abs(offset_y - path_position * move_y) - half_height
+                distance_to_path = math.hypot(max(0.0, distance_x), max(0.0, distance_y))
+
+                if distance_to_path > self.margin:
+                    continue
+
+                # tiles close to the path first, and earlier parts of the path before later ones
+                scored_tiles.append((distance_to_path + path_position, (zoom, x, y)))
+
+        # tiles of the next zoom level for the current viewport
+        next_zoom = zoom + zoom_direction
+        if zoom_direction != 0 and min_zoom <= next_zoom <= max_zoom:
+            factor = 2 ** zoom_direction
+            for x in range(max(0, math.floor(upper_left_tile_pos[0] * factor)), min(2 ** next_zoom, math.ceil(lower_right_tile_pos[0] * factor))):
+                for y in range(max(0, math.floor(upper_left_tile_pos[1] * factor)), min(2 ** next_zoom, math.ceil(lower_right_tile_pos[1] * factor))):
+                    distance = math.hypot((x + 0.5) / factor - center_x, (y + 0.5) / factor - center_y)
+                    scored_tiles.append((distance / max(half_width, half_height, 1), (next_zoom, x, y)))
+
+        scored_tiles.sort()
+        return [tile_key for score, tile_key in scored_tiles[:self.tile_budget]]
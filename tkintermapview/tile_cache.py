@@ -0,0 +1,96 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Union
+
+
+class TileImageCache:
+    """ thread-safe least recently used cache for tile images or encoded tile data with a memory budget in bytes
+
+        is_pinned(key) returns True for tiles which must not be evicted, for example the visible tiles """
+
+    def __init__(self, size_limit: int, is_pinned: Union[Callable, None] = None):
+        self.size_limit = size_limit
+        self.is_pinned = is_pinned
+
+        self.entries: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key: (image, size in bytes), least recently used first
+        self.size = 0
+        self.lock = threading.RLock()
+
+        self.number_of_hits = 0
+        self.number_of_misses = 0
+        self.number_of_evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.entries
+
+    def get(self, key: Hashable, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.number_of_misses += 1
+                return default
+
+            self.entries.move_to_end(key)
+            self.number_of_hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, image, size: int):
+        """ size: memory usage of the image in bytes """
+
+        with self.lock:
+            old_entry = self.entries.pop(key, None)
+            if old_entry is not None:
+                self.size -= old_entry[1]
+
+            self.entries[key] = (image, size)
+            self.size += size
+
+            if self.size > self.size_limit:
+                self.evict()
+
+    def remove(self, key: Hashable):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def remove_matching(self, predicate: Callable):
+        """ remove all entries for which predicate(key) is True """
+
+        with self.lock:
+            for key in [key for key in self.entries if predicate(key)]:
+                self.size -= self.entries.pop(key)[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def evict(self):
+        """ remove least recently used images which are not pinned, until size is within size_limit """
+
+        evicted_keys = []
+        for key, (image, size) in self.entries.items():
+            if self.size <= self.size_limit:
+                break
+            if self.is_pinned is not None and self.is_pinned(key):
+                continue
+
+            evicted_keys.append(key)
+            self.size -= size
+
+        for key in evicted_keys:
+            del self.entries[key]
+        self.number_of_evictions += len(evicted_keys)
+
+    def get_statistics(self) -> Dict[str, int]:
+        with self.lock:
+            return {"tiles": len(self.entries),
+                    "size": self.size,
+                    "size_limit": self.size_limit,
+                    "hits": self.number_of_hits,
+                    "misses": self.number_of_misses,
+                    "evictions": self.number_of_evictions}
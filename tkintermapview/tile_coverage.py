@@ -0,0 +1,147 @@
+import math
+from typing import Dict, List, Tuple
+
+from .utility_functions import decimal_to_osm
+
+# tile coverage of one zoom level: {x: [(y_start, y_stop), ...]}, sorted and not overlapping y ranges for every column
+Coverage = Dict[int, List[Tuple[int, int]]]
+
+EARTH_CIRCUMFERENCE = 40075016.686  # meters at the equator
+
+
+def merge_coverage(columns: Dict[int, List[Tuple[int, int]]]) -> Coverage:
+    """ sort the y ranges of every column and merge overlapping or adjacent ranges """
+
+    coverage = {}
+    for x in sorted(columns):
+        merged = []
+        for y_start, y_stop in sorted(columns[x]):
+            if len(merged) > 0 and y_start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], y_stop))
+            else:
+                merged.append((y_start, y_stop))
+        coverage[x] = merged
+    return coverage
+
+
+def get_number_of_tiles(coverage: Coverage) -> int:
+    return sum(y_stop - y_start for ranges in coverage.values() for y_start, y_stop in ranges)
+
+
+def get_line_tiles(start: Tuple[float, float], end: Tuple[float, float]) -> List[Tuple[int, int]]:
+    """ all tiles touched by the line from start to end in tile coordinates (grid traversal) """
+
+    x, y = math.floor(start[0]), math.floor(start[1])
+    end_x, end_y = math.floor(end[0]), math.floor(end[1])
+    delta_x, delta_y = end[0] - start[0], end[1] - start[1]
+    step_x = 1 if delta_x > 0 else -1
+    step_y = 1 if delta_y > 0 else -1
+
+    # line parameter t (0 to 1) of the next vertical and horizontal tile border
+    t_max_x = ((x + (step_x > 0)) - start[0]) / delta_x if delta_x != 0 else math.inf
+    t_max_y = ((y + (step_y > 0)) - start[1]) / delta_y if delta_y != 0 else math.inf
+    t_delta_x = abs(1 / delta_x) if delta_x != 0 else math.inf
+    t_delta_y = abs(1 / delta_y) if delta_y != 0 else math.inf
+
+    tiles = [(x, y)]
+    for i in range(abs(end_x - x) + abs(end_y - y)):
+        if t_max_x < t_max_y:
+            x += step_x
+            t_max_x += t_delta_x
+        else:
+            y += step_y
+            t_max_y += t_delta_y
+        tiles.append((x, y))
+    return tiles
+
+
+def rasterize_polygon(points: List[Tuple[float, float]], number_of_tiles: int, columns: Dict[int, List[Tuple[int, int]]]):
+    """ add all tiles inside or touched by the polygon (tile coordinates) to columns,
+        the border tiles are found by grid traversal of the edges, the inner tiles with one vertical scanline per column """
+
+    edges = [(points[i], points[(i + 1) % len(points)]) for i in range(len(points))]
+
+    for start, end in edges:
+        for x, y in get_line_tiles(start, end):
+            if 0 <= x < number_of_tiles and 0 <= y < number_of_tiles:
+                columns.setdefault(x, []).append((y, y + 1))
+
+    if len(points) < 3:
+        return
+
+    min_x = max(0, math.floor(min(point[0] for point in points)))
+    max_x = min(number_of_tiles - 1, math.floor(max(point[0] for point in points)))
+    for x in range(min_x, max_x + 1):
+        scan_x = x + 0.5
+
+        # y of all edges crossing the scanline, half open, so that a vertex on the scanline is counted once
+        crossings = sorted(start[1] + (scan_x - start[0]) * (end[1] - start[1]) / (end[0] - start[0])
+                           for start, end in edges if (start[0] <= scan_x < end[0]) or (end[0] <= scan_x < start[0]))
+
+        # even-odd rule, every tile the scanline passes inside the polygon is covered
+        for i in range(0, len(crossings) - 1, 2):
+            y_start = max(0, math.floor(crossings[i]))
+            y_stop = min(number_of_tiles, math.ceil(crossings[i + 1]))
+            if y_start < y_stop:
+                columns.setdefault(x, []).append((y_start, y_stop))
+
+
+def get_polygon_coverage(position_list: list, zoom: int) -> Coverage:
+    """ tiles of the zoom level inside or touched by the polygon, position_list is a list of (lat, lon) like for CanvasPolygon """
+
+    points = [decimal_to_osm(*position, zoom) for position in position_list]
+    columns = {}
+    rasterize_polygon(points, 2 ** zoom, columns)
+    return merge_coverage(columns)
+
+
+def get_path_coverage(position_list: list, buffer_distance: float, zoom: int) -> Coverage:
+    """ tiles of the zoom level closer than buffer_distance (meters) to the path, position_list is a list of (lat, lon) like for CanvasPath,
+        every segment is buffered to a rectangle with the tile size at its latitude """
+
+    number_of_tiles = 2 ** zoom
+    points = [decimal_to_osm(*position, zoom) for position in position_list]
+    columns = {}
+
+    for i in range(max(1, len(points) - 1)):
+        start, end = points[i], points[min(i + 1, len(points) - 1)]
+
+        # buffer distance in tiles at the mean latitude of the segment
+        latitude = (position_list[i][0] + position_list[min(i + 1, len(points) - 1)][0]) / 2
+        meters_per_tile = EARTH_CIRCUMFERENCE * math.cos(math.radians(latitude)) / number_of_tiles
+        buffer = buffer_distance / max(meters_per_tile, 1e-9)
+
+        length = math.hypot(end[0] - start[0], end[1] - start[1])
+        if length > 0:
+            direction = ((end[0] - start[0]) / length * buffer, (end[1] - start[1]) / length * buffer)
+        else:
+            direction = (buffer, 0)
+        normal = (-direction[1], direction[0])
+
+        rectangle = [(start[0] - direction[0] + normal[0], start[1] - direction[1] + normal[1]),
+                     (end[0] + direction[0] + normal[0], end[1] + direction[1] + normal[1]),
+                     (end[0] + direction[0] - normal[0], end[1] + direction[1] - normal[1]),
+                     (start[0] - direction[0] - normal[0], start[1] - direction[1] - normal[1])]
+        rasterize_polygon(rectangle, number_of_tiles, columns)
+
+    return merge_coverage(columns)
+
+
+def get_tile_list_coverage(tile_list: list, zoom: int) -> Coverage:
+    """ tiles of the zoom level in a list of (zoom, x, y) """
+
+    columns = {}
+    for tile_zoom, x, y in tile_list:
+        if tile_zoom == zoom:
+            columns.setdefault(x, []).append((y, y + 1))
+    return merge_coverage(columns)
+
+
+def get_rectangle_coverage(position_a: tuple, position_b: tuple, zoom: int) -> Coverage:
+    """ tiles of the zoom level between the upper left position_a and the lower right position_b """
+
+    upper_left_tile_pos = decimal_to_osm(*position_a, zoom)
+    lower_right_tile_pos = decimal_to_osm(*position_b, zoom)
+
+    y_range = (math.floor(upper_left_tile_pos[1]), math.ceil(lower_right_tile_pos[1]) + 1)
+    return {x: [y_range] for x in range(math.floor(upper_left_tile_pos[0]), math.ceil(lower_right_tile_pos[0]) + 1)}
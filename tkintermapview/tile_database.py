@@ -0,0 +1,820 @@
+import sqlite3
+import threading
+import queue
+import time
+import hashlib
+import sys
+from typing import Iterable, List, Set, Tuple, Union
+
+# storage layouts of the tiles, see create_deduplicated_tables and create_v2_tables
+LAYOUT_DEFAULT = "default"
+LAYOUT_DEDUPLICATED = "deduplicated"
+LAYOUT_V2 = "v2"
+
+# tile keys of schema version 2: zoom in the upper bits, then x and y with 29 bits each, up to zoom level 29
+TILE_KEY_BITS = 29
+TILE_KEY_MASK = (1 << TILE_KEY_BITS) - 1
+
+
+def create_tables(db_cursor: sqlite3.Cursor, layout: str = LAYOUT_DEFAULT):
+    """ create tables of the offline tile database if they not exist,
+        layout: storage layout of the tiles if the database is new, an existing database keeps its layout """
+
+    create_server_table = """CREATE TABLE IF NOT EXISTS server (
+                                    url VARCHAR(300) PRIMARY KEY NOT NULL,
+                                    max_zoom INTEGER NOT NULL);"""
+
+    create_tiles_table = """CREATE TABLE IF NOT EXISTS tiles (
+                                    zoom INTEGER NOT NULL,
+                                    x INTEGER NOT NULL,
+                                    y INTEGER NOT NULL,
+                                    server VARCHAR(300) NOT NULL,
+                                    tile_image BLOB NOT NULL,
+                                    CONSTRAINT fk_server FOREIGN KEY (server) REFERENCES server (url),
+                                    CONSTRAINT pk_tiles PRIMARY KEY (zoom, x, y, server));"""
+
+    create_sections_table = """CREATE TABLE IF NOT EXISTS sections (
+                                        position_a VARCHAR(100) NOT NULL,
+                                        position_b VARCHAR(100) NOT NULL,
+                                        zoom_a INTEGER NOT NULL,
+                                        zoom_b INTEGER NOT NULL,
+                                        server VARCHAR(300) NOT NULL,
+                                        CONSTRAINT fk_server FOREIGN KEY (server) REFERENCES server (url),
+                                        CONSTRAINT pk_tiles PRIMARY KEY (position_a, position_b, zoom_a, zoom_b, server));"""
+
+    # tiles that were stored by the write-through cache of the map widget, only these tiles get evicted
+    create_tile_cache_table = """CREATE TABLE IF NOT EXISTS tile_cache (
+                                        zoom INTEGER NOT NULL,
+                                        x INTEGER NOT NULL,
+                                        y INTEGER NOT NULL,
+                                        server VARCHAR(300) NOT NULL,
+                                        size INTEGER NOT NULL,
+                                        last_access REAL NOT NULL,
+                                        CONSTRAINT pk_tile_cache PRIMARY KEY (zoom, x, y, server));"""
+
+    create_tile_cache_index = """CREATE INDEX IF NOT EXISTS idx_tile_cache_last_access ON tile_cache (last_access);"""
+
+    # HTTP cache validation data of stored tiles, expires is a unix time
+    create_tile_validation_table = """CREATE TABLE IF NOT EXISTS tile_validation (
+                                            zoom INTEGER NOT NULL,
+                                            x INTEGER NOT NULL,
+                                            y INTEGER NOT NULL,
+                                            server VARCHAR(300) NOT NULL,
+                                            etag VARCHAR(300),
+                                            last_modified VARCHAR(100),
+                                            expires REAL NOT NULL,
+                                            CONSTRAINT pk_tile_validation PRIMARY KEY (zoom, x, y, server));"""
+
+    # region downloads of the OfflineLoader, every zoom level of a job has a checkpoint: all tiles with x < checkpoint_x are finished
+    create_download_jobs_table = """CREATE TABLE IF NOT EXISTS download_jobs (
+                                            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                            position_a VARCHAR(100) NOT NULL,
+                                            position_b VARCHAR(100) NOT NULL,
+                                            zoom_a INTEGER NOT NULL,
+                                            zoom_b INTEGER NOT NULL,
+                                            server VARCHAR(300) NOT NULL,
+                                            completed INTEGER NOT NULL DEFAULT 0,
+                                            created REAL NOT NULL);"""
+
+    create_download_progress_table = """CREATE TABLE IF NOT EXISTS download_progress (
+                                                job_id INTEGER NOT NULL,
+                                                zoom INTEGER NOT NULL,
+                                                checkpoint_x INTEGER NOT NULL,
+                                                completed INTEGER NOT NULL DEFAULT 0,
+                                                CONSTRAINT fk_job FOREIGN KEY (job_id) REFERENCES download_jobs (job_id),
+                                                CONSTRAINT pk_download_progress PRIMARY KEY (job_id, zoom));"""
+
+    # polygon, path and tile list downloads store their region as json, so that resume_download_jobs can continue them
+    create_download_regions_table = """CREATE TABLE IF NOT EXISTS download_regions (
+                                               job_id INTEGER PRIMARY KEY,
+                                               region TEXT NOT NULL,
+                                               CONSTRAINT fk_job FOREIGN KEY (job_id) REFERENCES download_jobs (job_id));"""
+
+    db_cursor.execute(create_server_table)
+    db_cursor.execute("SELECT 1 FROM sqlite_master WHERE name='tiles';")
+    if db_cursor.fetchone() is None:
+        if layout == LAYOUT_DEDUPLICATED:
+            create_deduplicated_tables(db_cursor)
+        elif layout == LAYOUT_V2:
+            create_v2_tables(db_cursor)
+    db_cursor.execute(create_tiles_table)  # does nothing if tiles is the view of another layout
+    db_cursor.execute(create_sections_table)
+    db_cursor.execute(create_tile_cache_table)
+    db_cursor.execute(create_tile_cache_index)
+    db_cursor.execute(create_tile_validation_table)
+    db_cursor.execute(create_download_jobs_table)
+    db_cursor.execute(create_download_progress_table)
+    db_cursor.execute(create_download_regions_table)
+
+
+def create_deduplicated_tables(db_cursor: sqlite3.Cursor):
+    """ deduplicated layout: identical tiles (ocean, desert, ...) are stored once in tile_blobs, keyed by the hash of their content,
+        and tile_hashes maps (zoom, x, y, server) to the hash, tiles is a read-only view with the columns of the normal tiles table,
+        so reading code works with all layouts, writing code uses TileTable """
+
+    create_tile_blobs_table = """CREATE TABLE IF NOT EXISTS tile_blobs (
+                                        hash BLOB PRIMARY KEY NOT NULL,
+                                        tile_image BLOB NOT NULL);"""
+
+    create_tile_hashes_table = """CREATE TABLE IF NOT EXISTS tile_hashes (
+                                        zoom INTEGER NOT NULL,
+                                        x INTEGER NOT NULL,
+                                        y INTEGER NOT NULL,
+                                        server VARCHAR(300) NOT NULL,
+                                        hash BLOB NOT NULL,
+                                        CONSTRAINT fk_server FOREIGN KEY (server) REFERENCES server (url),
+                                        CONSTRAINT pk_tile_hashes PRIMARY KEY (zoom, x, y, server));"""
+
+    create_tile_hashes_index = """CREATE INDEX IF NOT EXISTS idx_tile_hashes_hash ON tile_hashes (hash);"""
+
+    create_tiles_view = """CREATE VIEW IF NOT EXISTS tiles AS
+                                SELECT h.zoom AS zoom, h.x AS x, h.y AS y, h.server AS server, b.tile_image AS tile_image
+                                FROM tile_hashes h JOIN tile_blobs b ON b.hash = h.hash;"""
+
+    db_cursor.execute(create_tile_blobs_table)
+    db_cursor.execute(create_tile_hashes_table)
+    db_cursor.execute(create_tile_hashes_index)
+    db_cursor.execute(create_tiles_view)
+
+
+def create_v2_tables(db_cursor: sqlite3.Cursor):
+    """ schema version 2: tile_index maps (server_id, tile_key) to the blob of the tile, it is a WITHOUT ROWID table, so the rows are
+        stored in the primary key b-tree and a lookup compares two integers instead of the tile server url,
+        the deduplicated blobs are stored in tile_data, which keeps the large images out of the b-tree of tile_index,
+        tile_cache and tile_validation are keyed by (server_id, tile_key) too, server_id is a column of the server table,
+        tiles is a read-only view with the columns of the normal tiles table, fast queries use TileTable """
+
+    # the server table gets a stable integer id, the rowid of a table without INTEGER PRIMARY KEY may change on VACUUM
+    create_server_table = """CREATE TABLE server_new (
+                                    server_id INTEGER PRIMARY KEY,
+                                    url VARCHAR(300) UNIQUE NOT NULL,
+                                    max_zoom INTEGER NOT NULL);"""
+
+    create_tile_data_table = """CREATE TABLE IF NOT EXISTS tile_data (
+                                        blob_id INTEGER PRIMARY KEY,
+                                        hash BLOB UNIQUE NOT NULL,
+                                        tile_image BLOB NOT NULL);"""
+
+    create_tile_index_table = """CREATE TABLE IF NOT EXISTS tile_index (
+                                        server_id INTEGER NOT NULL,
+                                        tile_key INTEGER NOT NULL,
+                                        blob_id INTEGER NOT NULL,
+                                        CONSTRAINT pk_tile_index PRIMARY KEY (server_id, tile_key)) WITHOUT ROWID;"""
+
+    create_tile_index_blob_index = """CREATE INDEX IF NOT EXISTS idx_tile_index_blob_id ON tile_index (blob_id);"""
+
+    create_tile_cache_table = """CREATE TABLE IF NOT EXISTS tile_cache (
+                                        server_id INTEGER NOT NULL,
+                                        tile_key INTEGER NOT NULL,
+                                        size INTEGER NOT NULL,
+                                        last_access REAL NOT NULL,
+                                        CONSTRAINT pk_tile_cache PRIMARY KEY (server_id, tile_key)) WITHOUT ROWID;"""
+
+    create_tile_validation_table = """CREATE TABLE IF NOT EXISTS tile_validation (
+                                            server_id INTEGER NOT NULL,
+                                            tile_key INTEGER NOT NULL,
+                                            etag VARCHAR(300),
+                                            last_modified VARCHAR(100),
+                                            expires REAL NOT NULL,
+                                            CONSTRAINT pk_tile_validation PRIMARY KEY (server_id, tile_key)) WITHOUT ROWID;"""
+
+    create_tiles_view = f"""CREATE VIEW IF NOT EXISTS tiles AS
+                                SELECT i.tile_key >> {2 * TILE_KEY_BITS} AS zoom, (i.tile_key >> {TILE_KEY_BITS}) & {TILE_KEY_MASK} AS x,
+                                       i.tile_key & {TILE_KEY_MASK} AS y, s.url AS server, d.tile_image AS tile_image
+                                FROM tile_index i JOIN server s ON s.server_id = i.server_id JOIN tile_data d ON d.blob_id = i.blob_id;"""
+
+    db_cursor.execute("PRAGMA table_info(server);")
+    if "server_id" not in [column[1] for column in db_cursor.fetchall()]:
+        # copy into a new table, renaming the old one would rename the foreign keys of the other tables too
+        db_cursor.execute(create_server_table)
+        db_cursor.execute("INSERT INTO server_new (url, max_zoom) SELECT url, max_zoom FROM server;")
+        db_cursor.execute("DROP TABLE server;")
+        db_cursor.execute("ALTER TABLE server_new RENAME TO server;")
+
+    db_cursor.execute(create_tile_data_table)
+    db_cursor.execute(create_tile_index_table)
+    db_cursor.execute(create_tile_index_blob_index)
+    db_cursor.execute(create_tile_cache_table)
+    db_cursor.execute(create_tile_validation_table)
+    db_cursor.execute(create_tiles_view)
+    db_cursor.execute("PRAGMA user_version=2;")
+
+
+def get_layout(db_cursor: sqlite3.Cursor) -> str:
+    """ storage layout of the tiles of the database, LAYOUT_DEFAULT for a new database """
+
+    db_cursor.execute("PRAGMA user_version;")
+    if db_cursor.fetchone()[0] >= 2:
+        return LAYOUT_V2
+
+    db_cursor.execute("SELECT type FROM sqlite_master WHERE name='tiles';")
+    result = db_cursor.fetchone()
+    return LAYOUT_DEDUPLICATED if result is not None and result[0] == "view" else LAYOUT_DEFAULT
+
+
+def get_tile_hash(tile_image: bytes) -> bytes:
+    return hashlib.blake2b(tile_image, digest_size=16).digest()
+
+
+def pack_tile_key(zoom: int, x: int, y: int) -> int:
+    return (zoom << (2 * TILE_KEY_BITS)) | (x << TILE_KEY_BITS) | y
+
+
+def unpack_tile_key(tile_key: int) -> Tuple[int, int, int]:
+    return tile_key >> (2 * TILE_KEY_BITS), (tile_key >> TILE_KEY_BITS) & TILE_KEY_MASK, tile_key & TILE_KEY_MASK
+
+
+class TileTable:
+    """ reads and writes the tiles of an offline tile database in its storage layout,
+        queries that need to be fast go through this class instead of the tiles view of the other layouts """
+
+    def __init__(self, db_cursor: sqlite3.Cursor):
+        self.db_cursor = db_cursor
+        self.layout = get_layout(db_cursor)
+        self.server_ids = {}  # key: server url, value: server_id of schema version 2
+
+        # primary key of tile_cache and tile_validation
+        if self.layout == LAYOUT_V2:
+            self.key_columns, self.key_placeholders, self.key_condition = "server_id, tile_key", "?, ?", "server_id=? AND tile_key=?"
+        else:
+            self.key_columns, self.key_placeholders, self.key_condition = "zoom, x, y, server", "?, ?, ?, ?", "zoom=? AND x=? AND y=? AND server=?"
+
+    def get_server_id(self, server: str, create: bool = False) -> Union[int, None]:
+        """ server_id of schema version 2, create: register servers that are not in the server table yet """
+
+        server_id = self.server_ids.get(server)
+        if server_id is None:
+            if create:
+                self.db_cursor.execute("INSERT OR IGNORE INTO server (url, max_zoom) VALUES (?, ?);", (server, 19))
+            self.db_cursor.execute("SELECT server_id FROM server WHERE url=?;", (server,))
+            result = self.db_cursor.fetchone()
+            if result is None:
+                return None
+            server_id = self.server_ids[server] = result[0]
+        return server_id
+
+    def get_tile(self, zoom: int, x: int, y: int, server: str) -> Union[bytes, None]:
+        if self.layout == LAYOUT_V2:
+            server_id = self.get_server_id(server)
+            if server_id is None:
+                return None
+            self.db_cursor.execute("""SELECT d.tile_image FROM tile_index i JOIN tile_data d ON d.blob_id = i.blob_id
+                                      WHERE i.server_id=? AND i.tile_key=?;""", (server_id, pack_tile_key(zoom, x, y)))
+        else:
+            self.db_cursor.execute("SELECT t.tile_image FROM tiles t WHERE t.zoom=? AND t.x=? AND t.y=? AND t.server=?;", (zoom, x, y, server))
+
+        result = self.db_cursor.fetchone()
+        return result[0] if result is not None else None
+
+    def get_tile_validation(self, zoom: int, x: int, y: int, server: str) -> Union[tuple, None]:
+        """ returns (etag, last_modified, expires) of a stored tile, None if there is no validation data """
+
+        key = self.get_key(zoom, x, y, server)
+        if key is None:
+            return None
+        self.db_cursor.execute(f"SELECT etag, last_modified, expires FROM tile_validation WHERE {self.key_condition};", key)
+        return self.db_cursor.fetchone()
+
+    def get_key(self, zoom: int, x: int, y: int, server: str, create: bool = False) -> Union[tuple, None]:
+        """ primary key of the tile in tile_cache and tile_validation, None if the server is not registered in schema version 2 """
+
+        if self.layout != LAYOUT_V2:
+            return zoom, x, y, server
+        server_id = self.get_server_id(server, create=create)
+        return (server_id, pack_tile_key(zoom, x, y)) if server_id is not None else None
+
+    def get_keys(self, tile_keys: Iterable[tuple], create: bool = False) -> List[tuple]:
+        """ primary keys of (zoom, x, y, server) tile keys, tiles of unknown servers are left out """
+
+        return [key for key in (self.get_key(*tile_key, create=create) for tile_key in tile_keys) if key is not None]
+
+    def set_tile_validations(self, validation_rows: List[tuple]):
+        """ insert or replace (zoom, x, y, server, etag, last_modified, expires) rows """
+
+        self.db_cursor.executemany(f"INSERT OR REPLACE INTO tile_validation ({self.key_columns}, etag, last_modified, expires) "
+                                   f"VALUES ({self.key_placeholders}, ?, ?, ?);",
+                                   [(*self.get_key(*row[:4], create=True), *row[4:]) for row in validation_rows])
+
+    def insert_cache_entries(self, cache_rows: List[tuple]):
+        """ insert or replace (zoom, x, y, server, size, last_access) rows of tiles stored by the write-through cache """
+
+        self.db_cursor.executemany(f"INSERT OR REPLACE INTO tile_cache ({self.key_columns}, size, last_access) "
+                                   f"VALUES ({self.key_placeholders}, ?, ?);",
+                                   [(*self.get_key(*row[:4], create=True), *row[4:]) for row in cache_rows])
+
+    def update_cache_entries(self, column: str, rows: List[tuple]):
+        """ set size or last_access of cache entries, rows: (value, zoom, x, y, server) """
+
+        update_rows = []
+        for value, *tile_key in rows:
+            key = self.get_key(*tile_key)
+            if key is not None:
+                update_rows.append((value, *key))
+        self.db_cursor.executemany(f"UPDATE tile_cache SET {column}=? WHERE {self.key_condition};", update_rows)
+
+    def get_cache_size(self) -> int:
+        self.db_cursor.execute("SELECT COALESCE(SUM(size), 0) FROM tile_cache;")
+        return self.db_cursor.fetchone()[0]
+
+    def get_least_recently_used_tiles(self, limit: int) -> List[tuple]:
+        """ returns (zoom, x, y, server, size) of the cached tiles with the oldest last_access """
+
+        if self.layout == LAYOUT_V2:
+            self.db_cursor.execute("""SELECT c.tile_key, s.url, c.size FROM tile_cache c JOIN server s ON s.server_id = c.server_id
+                                      ORDER BY c.last_access LIMIT ?;""", (limit,))
+            return [(*unpack_tile_key(tile_key), server, size) for tile_key, server, size in self.db_cursor.fetchall()]
+
+        self.db_cursor.execute("SELECT zoom, x, y, server, size FROM tile_cache ORDER BY last_access LIMIT ?;", (limit,))
+        return self.db_cursor.fetchall()
+
+    def get_stored_tiles(self, zoom: int, server: str, x_range: range, y_range: range) -> Set[Tuple[int, int]]:
+        """ returns (x, y) of all stored tiles of server in the rectangle, with range queries over the primary key """
+
+        if len(x_range) == 0 or len(y_range) == 0:
+            return set()
+
+        if self.layout == LAYOUT_V2:
+            server_id = self.get_server_id(server)
+            if server_id is None:
+                return set()
+
+            # the tiles of a column have consecutive keys
+            stored_tiles = set()
+            for x in x_range:
+                self.db_cursor.execute("SELECT tile_key FROM tile_index WHERE server_id=? AND tile_key BETWEEN ? AND ?;",
+                                       (server_id, pack_tile_key(zoom, x, y_range.start), pack_tile_key(zoom, x, y_range.stop - 1)))
+                stored_tiles.update((x, tile_key & TILE_KEY_MASK) for tile_key, in self.db_cursor.fetchall())
+            return stored_tiles
+
+        self.db_cursor.execute("SELECT t.x, t.y FROM tiles t WHERE t.zoom=? AND t.server=? AND t.x BETWEEN ? AND ? AND t.y BETWEEN ? AND ?;",
+                               (zoom, server, x_range.start, x_range.stop - 1, y_range.start, y_range.stop - 1))
+        return set(self.db_cursor.fetchall())
+
+    def get_existing_tiles(self, tile_keys: Iterable[tuple]) -> Set[tuple]:
+        """ returns the (zoom, x, y, server) keys of tile_keys that are stored """
+
+        return {tile_key for tile_key in tile_keys if self.get_blob_key(tile_key) is not None}
+
+    def get_stale_tiles(self, server: str, last_key: tuple, refresh_time: float, limit: int = 500) -> List[tuple]:
+        """ returns (zoom, x, y, etag, last_modified) of tiles of server that expired before refresh_time or have no validation data,
+            in the order of (zoom, x, y) after last_key, at most limit tiles """
+
+        if self.layout == LAYOUT_V2:
+            server_id = self.get_server_id(server)
+            if server_id is None:
+                return []
+
+            self.db_cursor.execute("""SELECT i.tile_key, v.etag, v.last_modified FROM tile_index i
+                                      LEFT JOIN tile_validation v ON v.server_id = i.server_id AND v.tile_key = i.tile_key
+                                      WHERE i.server_id=? AND i.tile_key > ? AND (v.expires IS NULL OR v.expires < ?)
+                                      ORDER BY i.tile_key LIMIT ?;""",
+                                   (server_id, pack_tile_key(*last_key) if last_key[0] >= 0 else -1, refresh_time, limit))
+            return [(*unpack_tile_key(tile_key), etag, last_modified) for tile_key, etag, last_modified in self.db_cursor.fetchall()]
+
+        self.db_cursor.execute("""SELECT t.zoom, t.x, t.y, v.etag, v.last_modified FROM tiles t
+                                  LEFT JOIN tile_validation v ON v.zoom=t.zoom AND v.x=t.x AND v.y=t.y AND v.server=t.server
+                                  WHERE t.server=? AND (t.zoom, t.x, t.y) > (?, ?, ?) AND (v.expires IS NULL OR v.expires < ?)
+                                  ORDER BY t.zoom, t.x, t.y LIMIT ?;""", (server, *last_key, refresh_time, limit))
+        return self.db_cursor.fetchall()
+
+    def get_blob_key(self, tile_key: tuple) -> Union[bytes, int, None]:
+        """ returns hash (deduplicated layout) or blob_id (schema version 2) of the stored tile, True for the default layout """
+
+        zoom, x, y, server = tile_key
+        if self.layout == LAYOUT_V2:
+            server_id = self.get_server_id(server)
+            if server_id is None:
+                return None
+            self.db_cursor.execute("SELECT blob_id FROM tile_index WHERE server_id=? AND tile_key=?;", (server_id, pack_tile_key(zoom, x, y)))
+        elif self.layout == LAYOUT_DEDUPLICATED:
+            self.db_cursor.execute("SELECT hash FROM tile_hashes WHERE zoom=? AND x=? AND y=? AND server=?;", tile_key)
+        else:
+            self.db_cursor.execute("SELECT 1 FROM tiles WHERE zoom=? AND x=? AND y=? AND server=?;", tile_key)
+
+        result = self.db_cursor.fetchone()
+        if result is None:
+            return None
+        return result[0] if self.layout != LAYOUT_DEFAULT else True
+
+    def insert_tiles(self, tile_rows: List[tuple], replace: bool = False):
+        """ insert (zoom, x, y, server, tile_image) rows, replace: overwrite existing tiles, otherwise they are kept """
+
+        if len(tile_rows) == 0:
+            return
+        conflict_resolution = "REPLACE" if replace else "IGNORE"
+
+        if self.layout == LAYOUT_DEFAULT:
+            self.db_cursor.executemany(f"INSERT OR {conflict_resolution} INTO tiles (zoom, x, y, server, tile_image) VALUES (?, ?, ?, ?, ?);",
+                                       tile_rows)
+            return
+
+        hashes = [get_tile_hash(tile_row[4]) for tile_row in tile_rows]
+        old_blob_keys = [self.get_blob_key(tile_row[:4]) for tile_row in tile_rows] if replace else []
+
+        if self.layout == LAYOUT_V2:
+            self.db_cursor.executemany("INSERT OR IGNORE INTO tile_data (hash, tile_image) VALUES (?, ?);",
+                                       [(tile_hash, tile_row[4]) for tile_hash, tile_row in zip(hashes, tile_rows)])
+            self.db_cursor.executemany(f"""INSERT OR {conflict_resolution} INTO tile_index (server_id, tile_key, blob_id)
+                                           SELECT ?, ?, blob_id FROM tile_data WHERE hash=?;""",
+                                       [(self.get_server_id(tile_row[3], create=True), pack_tile_key(*tile_row[:3]), tile_hash)
+                                        for tile_hash, tile_row in zip(hashes, tile_rows)])
+        else:
+            self.db_cursor.executemany("INSERT OR IGNORE INTO tile_blobs (hash, tile_image) VALUES (?, ?);",
+                                       [(tile_hash, tile_row[4]) for tile_hash, tile_row in zip(hashes, tile_rows)])
+            self.db_cursor.executemany(f"INSERT OR {conflict_resolution} INTO tile_hashes (zoom, x, y, server, hash) VALUES (?, ?, ?, ?, ?);",
+                                       [(*tile_row[:4], tile_hash) for tile_hash, tile_row in zip(hashes, tile_rows)])
+
+        # blobs of replaced tiles, and new blobs of tiles that already existed, may not be used anymore,
+        # if all tiles were new (rowcount of executemany is the sum of inserted rows), no blob can be unused
+        if replace:
+            self.remove_unused_blobs([blob_key for blob_key in old_blob_keys if blob_key is not None])
+        elif self.db_cursor.rowcount == len(tile_rows):
+            pass
+        elif self.layout == LAYOUT_V2:
+            self.remove_unused_blobs(self.get_blob_ids(hashes))
+        else:
+            self.remove_unused_blobs(hashes)
+
+    def get_blob_ids(self, hashes: Iterable[bytes]) -> List[int]:
+        blob_ids = []
+        for tile_hash in set(hashes):
+            self.db_cursor.execute("SELECT blob_id FROM tile_data WHERE hash=?;", (tile_hash,))
+            result = self.db_cursor.fetchone()
+            if result is not None:
+                blob_ids.append(result[0])
+        return blob_ids
+
+    def delete_tiles(self, tile_keys: List[tuple]):
+        """ delete tiles by (zoom, x, y, server), with their cache entries and validation data """
+
+        keys = self.get_keys(tile_keys)
+        self.db_cursor.executemany(f"DELETE FROM tile_cache WHERE {self.key_condition};", keys)
+        self.db_cursor.executemany(f"DELETE FROM tile_validation WHERE {self.key_condition};", keys)
+
+        if self.layout == LAYOUT_DEFAULT:
+            self.db_cursor.executemany("DELETE FROM tiles WHERE zoom=? AND x=? AND y=? AND server=?;", tile_keys)
+            return
+
+        old_blob_keys = [blob_key for blob_key in map(self.get_blob_key, tile_keys) if blob_key is not None]
+        if self.layout == LAYOUT_V2:
+            self.db_cursor.executemany("DELETE FROM tile_index WHERE server_id=? AND tile_key=?;", keys)
+        else:
+            self.db_cursor.executemany("DELETE FROM tile_hashes WHERE zoom=? AND x=? AND y=? AND server=?;", tile_keys)
+        self.remove_unused_blobs(old_blob_keys)
+
+    def remove_unused_blobs(self, blob_keys: Iterable[Union[bytes, int]]):
+        """ delete the blobs with the given hashes or blob_ids which are not referenced by a tile anymore """
+
+        if self.layout == LAYOUT_V2:
+            self.db_cursor.executemany("DELETE FROM tile_data WHERE blob_id=? AND NOT EXISTS (SELECT 1 FROM tile_index i WHERE i.blob_id=?);",
+                                       [(blob_id, blob_id) for blob_id in set(blob_keys)])
+        else:
+            self.db_cursor.executemany("DELETE FROM tile_blobs WHERE hash=? AND NOT EXISTS (SELECT 1 FROM tile_hashes h WHERE h.hash=?);",
+                                       [(tile_hash, tile_hash) for tile_hash in set(blob_keys)])
+
+    def get_statistics(self) -> dict:
+        """ returns the number of tiles and of stored images """
+
+        if self.layout == LAYOUT_V2:
+            self.db_cursor.execute("SELECT (SELECT COUNT(*) FROM tile_index), (SELECT COUNT(*) FROM tile_data);")
+        elif self.layout == LAYOUT_DEDUPLICATED:
+            self.db_cursor.execute("SELECT (SELECT COUNT(*) FROM tile_hashes), (SELECT COUNT(*) FROM tile_blobs);")
+        else:
+            self.db_cursor.execute("SELECT COUNT(*), COUNT(*) FROM tiles;")
+        number_of_tiles, number_of_blobs = self.db_cursor.fetchone()
+        return {"layout": self.layout, "tiles": number_of_tiles, "blobs": number_of_blobs}
+
+
+def migrate_tile_database(database_path: str, layout: str = LAYOUT_V2, batch_size: int = 10000, vacuum: bool = True) -> dict:
+    """ migrate an offline tile database to another storage layout in a single transaction, the tiles are copied in batches
+        without decoding, vacuum: shrink the database file afterwards, needs free disk space of the size of the database,
+        returns the layout and the number of tiles and of stored images """
+
+    db_connection = sqlite3.connect(database_path, timeout=30)
+    db_cursor = db_connection.cursor()
+    create_tables(db_cursor)
+    db_connection.commit()
+
+    old_layout = get_layout(db_cursor)
+    if old_layout == layout:
+        statistics = TileTable(db_cursor).get_statistics()
+        db_connection.close()
+        return statistics
+
+    db_cursor.execute("BEGIN;")  # explicit transaction, so that the schema changes get rolled back too if the migration fails
+
+    # move the old tiles out of the way, the tables of the other layouts are read directly
+    if old_layout == LAYOUT_DEFAULT:
+        db_cursor.execute("ALTER TABLE tiles RENAME TO tiles_old;")
+        old_tiles_query = "SELECT zoom, x, y, server, tile_image FROM tiles_old"
+    elif old_layout == LAYOUT_DEDUPLICATED:
+        db_cursor.execute("DROP VIEW tiles;")
+        old_tiles_query = "SELECT h.zoom, h.x, h.y, h.server, b.tile_image FROM tile_hashes h JOIN tile_blobs b ON b.hash = h.hash"
+    else:
+        db_cursor.execute("DROP VIEW tiles;")
+        old_tiles_query = f"""SELECT i.tile_key >> {2 * TILE_KEY_BITS}, (i.tile_key >> {TILE_KEY_BITS}) & {TILE_KEY_MASK}, i.tile_key & {TILE_KEY_MASK},
+                                     s.url, d.tile_image
+                              FROM tile_index i JOIN server s ON s.server_id = i.server_id JOIN tile_data d ON d.blob_id = i.blob_id"""
+    db_cursor.execute("PRAGMA user_version=0;")
+
+    # tile_cache and tile_validation have other primary keys in schema version 2
+    convert_metadata = (old_layout == LAYOUT_V2) != (layout == LAYOUT_V2)
+    if convert_metadata:
+        db_cursor.execute("DROP INDEX IF EXISTS idx_tile_cache_last_access;")
+        db_cursor.execute("ALTER TABLE tile_cache RENAME TO tile_cache_old;")
+        db_cursor.execute("ALTER TABLE tile_validation RENAME TO tile_validation_old;")
+
+    if layout == LAYOUT_DEDUPLICATED:
+        create_deduplicated_tables(db_cursor)
+    elif layout == LAYOUT_V2:
+        create_v2_tables(db_cursor)
+    create_tables(db_cursor)  # creates the tiles table of the default layout and the missing metadata tables
+    tile_table = TileTable(db_cursor)
+
+    # stream the old tiles with a second cursor, while the first one writes the new tables,
+    # without ORDER BY, so that SQLite doesn't sort all images in a temporary table first
+    read_cursor = db_connection.cursor()
+    read_cursor.execute(f"{old_tiles_query};")
+    while True:
+        tile_rows = read_cursor.fetchmany(batch_size)
+        if len(tile_rows) == 0:
+            break
+        tile_table.insert_tiles(tile_rows)
+
+    # copy the metadata of stored tiles, the servers are registered by insert_tiles
+    if convert_metadata:
+        tile_key = f"(o.zoom << {2 * TILE_KEY_BITS}) | (o.x << {TILE_KEY_BITS}) | o.y"
+        zoom_x_y = f"o.tile_key >> {2 * TILE_KEY_BITS}, (o.tile_key >> {TILE_KEY_BITS}) & {TILE_KEY_MASK}, o.tile_key & {TILE_KEY_MASK}"
+        if layout == LAYOUT_V2:
+            db_cursor.execute(f"""INSERT OR IGNORE INTO tile_cache (server_id, tile_key, size, last_access)
+                                  SELECT s.server_id, {tile_key}, o.size, o.last_access FROM tile_cache_old o JOIN server s ON s.url = o.server;""")
+            db_cursor.execute(f"""INSERT OR IGNORE INTO tile_validation (server_id, tile_key, etag, last_modified, expires)
+                                  SELECT s.server_id, {tile_key}, o.etag, o.last_modified, o.expires
+                                  FROM tile_validation_old o JOIN server s ON s.url = o.server;""")
+        else:
+            db_cursor.execute(f"""INSERT OR IGNORE INTO tile_cache (zoom, x, y, server, size, last_access)
+                                  SELECT {zoom_x_y}, s.url, o.size, o.last_access FROM tile_cache_old o JOIN server s ON s.server_id = o.server_id;""")
+            db_cursor.execute(f"""INSERT OR IGNORE INTO tile_validation (zoom, x, y, server, etag, last_modified, expires)
+                                  SELECT {zoom_x_y}, s.url, o.etag, o.last_modified, o.expires
+                                  FROM tile_validation_old o JOIN server s ON s.server_id = o.server_id;""")
+        db_cursor.execute("DROP TABLE tile_cache_old;")
+        db_cursor.execute("DROP TABLE tile_validation_old;")
+
+    # remove the tables of the old layout
+    if old_layout == LAYOUT_DEFAULT:
+        db_cursor.execute("DROP TABLE tiles_old;")
+    elif old_layout == LAYOUT_DEDUPLICATED:
+        db_cursor.execute("DROP TABLE tile_hashes;")
+        db_cursor.execute("DROP TABLE tile_blobs;")
+    else:
+        db_cursor.execute("DROP TABLE tile_index;")
+        db_cursor.execute("DROP TABLE tile_data;")
+    db_connection.commit()
+
+    statistics = tile_table.get_statistics()
+    if vacuum:
+        db_cursor.execute("VACUUM;")
+    db_connection.close()
+    return statistics
+
+
+def deduplicate_tile_database(database_path: str, batch_size: int = 1000, vacuum: bool = True) -> dict:
+    """ migrate an offline tile database to the deduplicated layout, databases with schema version 2 are already deduplicated,
+        returns the number of tiles and of distinct blobs """
+
+    db_connection = sqlite3.connect(database_path, timeout=30)
+    db_cursor = db_connection.cursor()
+    create_tables(db_cursor)
+    layout = get_layout(db_cursor)
+    db_connection.close()
+
+    if layout != LAYOUT_DEFAULT:
+        layout_statistics = migrate_tile_database(database_path, layout=layout)
+    else:
+        layout_statistics = migrate_tile_database(database_path, layout=LAYOUT_DEDUPLICATED, batch_size=batch_size, vacuum=vacuum)
+    return {"tiles": layout_statistics["tiles"], "blobs": layout_statistics["blobs"]}
+
+
+class TileDatabaseWriter:
+    """ single background thread which writes tiles to the database in batched transactions
+
+        cache_size_limit: if not None, tiles inserted with cache=True are evicted in least recently used
+        order when their total size in bytes exceeds this limit
+        page_cache_size: size of the SQLite page cache of the writer in bytes
+
+        a batch that fails, for example because the database is locked, is retried max_write_attempts times, if it still fails its tiles
+        are lost and the error is kept in error: flush() and close() raise it, and statements of execute() are not run anymore,
+        because the tiles they depend on may be missing """
+
+    def __init__(self, db_path: str,
+                 batch_size: int = 200,
+                 flush_interval: float = 1.0,
+                 max_queue_size: int = 5000,
+                 cache_size_limit: Union[int, None] = None,
+                 page_cache_size: int = 64 * 1024 ** 2,
+                 max_write_attempts: int = 5):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval  # max seconds until a started batch gets committed
+        self.cache_size_limit = cache_size_limit
+        self.page_cache_size = page_cache_size
+        self.max_write_attempts = max_write_attempts
+        self.layout = LAYOUT_DEFAULT  # storage layout of the database, set by the writer thread
+
+        self.task_queue = queue.Queue(maxsize=max_queue_size)  # blocks inserting threads if the writer can't keep up
+        self.number_of_written_tiles = 0
+        self.number_of_evicted_tiles = 0
+        self.number_of_lost_tiles = 0
+        self.error: Union[sqlite3.Error, None] = None  # first error of a batch that could not be written
+
+        self.thread = threading.Thread(daemon=True, target=self.write_tiles_background)
+        self.thread.start()
+
+    def insert_tile(self, zoom: int, x: int, y: int, server: str, tile_image: bytes, cache: bool = False,
+                    validation: Union[tuple, None] = None, replace: bool = False):
+        """ validation: (etag, last_modified, expires) of the HTTP response, replace: overwrite existing tile """
+
+        self.task_queue.put(("insert", ((zoom, x, y, server, tile_image), cache, validation, replace)))
+
+    def update_tile_validation(self, zoom: int, x: int, y: int, server: str, validation: tuple):
+        """ store new (etag, last_modified, expires) of a tile that was revalidated with 304 Not Modified """
+
+        self.task_queue.put(("validate", (zoom, x, y, server, *validation)))
+
+    def execute(self, sql: str, parameters: tuple = ()):
+        """ run a statement in the same transaction as the tiles inserted before, for example a download checkpoint,
+            so that it is never committed before these tiles """
+
+        self.task_queue.put(("execute", (sql, parameters)))
+
+    def delete_tile(self, zoom: int, x: int, y: int, server: str):
+        """ delete a tile, for example because its data is no image """
+
+        self.task_queue.put(("delete", (zoom, x, y, server)))
+
+    def touch_tile(self, zoom: int, x: int, y: int, server: str):
+        """ mark cached tile as recently used, gets dropped if the writer is busy """
+
+        try:
+            self.task_queue.put_nowait(("touch", (zoom, x, y, server)))
+        except queue.Full:
+            pass
+
+    def flush(self):
+        """ blocks until all tiles inserted so far are committed, raises error if a batch could not be written """
+
+        flushed_event = threading.Event()
+        self.task_queue.put(("flush", flushed_event))
+        flushed_event.wait()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """ commits the remaining tiles and stops the writer thread, raises error if a batch could not be written """
+
+        self.task_queue.put(("close", None))
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def configure_connection(self, db_cursor: sqlite3.Cursor):
+        """ write-ahead log, so that readers are not blocked by the writer, and a commit needs no fsync of the database file,
+            with synchronous=NORMAL the last commits may get lost on power failure, but the database stays consistent """
+
+        try:
+            db_cursor.execute("PRAGMA journal_mode=WAL;")
+        except sqlite3.OperationalError:
+            pass  # database is locked by another connection, keep the current journal mode
+        db_cursor.execute("PRAGMA synchronous=NORMAL;")
+        db_cursor.execute(f"PRAGMA cache_size={-(self.page_cache_size // 1024)};")  # negative value: size in KiB
+        db_cursor.execute("PRAGMA temp_store=MEMORY;")
+
+    def write_tiles_background(self):
+        db_connection = sqlite3.connect(self.db_path, timeout=30)
+        db_cursor = db_connection.cursor()
+        self.configure_connection(db_cursor)
+        create_tables(db_cursor)
+        db_connection.commit()
+        tile_table = TileTable(db_cursor)
+        self.layout = tile_table.layout
+
+        running = True
+        while running:
+            # wait for first task of the next batch
+            batch = [self.task_queue.get()]
+            batch_deadline = time.time() + self.flush_interval
+
+            # collect more tasks until batch is full or flush_interval is over
+            while len(batch) < self.batch_size and batch[-1][0] not in ("flush", "close"):
+                try:
+                    batch.append(self.task_queue.get(timeout=max(0.0, batch_deadline - time.time())))
+                except queue.Empty:
+                    break
+
+            tile_rows, replace_rows, cache_rows, validation_rows, touch_rows, statements, flushed_events = [], [], [], [], [], [], []
+            delete_keys = []
+            access_time = time.time()
+
+            for task_type, data in batch:
+                if task_type == "insert":
+                    tile_row, cache, validation, replace = data
+                    zoom, x, y, server, tile_image = tile_row
+
+                    if replace:
+                        replace_rows.append(tile_row)
+                    else:
+                        tile_rows.append(tile_row)
+                    if cache:
+                        cache_rows.append((zoom, x, y, server, len(tile_image), access_time))
+                    if validation is not None:
+                        validation_rows.append((zoom, x, y, server, *validation))
+                elif task_type == "validate":
+                    validation_rows.append(data)
+                elif task_type == "touch":
+                    touch_rows.append((access_time, *data))
+                elif task_type == "delete":
+                    delete_keys.append(data)
+                elif task_type == "execute":
+                    statements.append(data)
+                elif task_type == "flush":
+                    flushed_events.append(data)
+                elif task_type == "close":
+                    running = False
+
+            # statements must not be committed without the tiles before them, after a lost batch they are dropped
+            if self.error is not None:
+                statements = []
+
+            for attempt in range(1, self.max_write_attempts + 1):
+                try:
+                    # register cache entries first, tiles that are already stored by the OfflineLoader are never evicted
+                    existing_tiles = tile_table.get_existing_tiles(cache_row[:4] for cache_row in cache_rows)
+                    tile_table.insert_cache_entries([cache_row for cache_row in cache_rows if cache_row[:4] not in existing_tiles])
+                    tile_table.insert_tiles(tile_rows)
+                    tile_table.insert_tiles(replace_rows, replace=True)
+                    tile_table.update_cache_entries("size", [(len(row[4]), *row[:4]) for row in replace_rows])
+                    tile_table.set_tile_validations(validation_rows)
+                    tile_table.update_cache_entries("last_access", touch_rows)
+                    tile_table.delete_tiles(delete_keys)
+                    for sql, parameters in statements:
+                        db_cursor.execute(sql, parameters)
+                    db_connection.commit()
+                    self.number_of_written_tiles += len(tile_rows) + len(replace_rows)
+                    break
+
+                except sqlite3.Error as err:
+                    db_connection.rollback()
+
+                    # a locked database or a full disk may be temporary, other errors are not retried
+                    if isinstance(err, sqlite3.OperationalError) and attempt < self.max_write_attempts:
+                        sys.stderr.write(f"[TileDatabaseWriter] {err}, retrying batch ({attempt}/{self.max_write_attempts})\n")
+                        time.sleep(0.5 * attempt)
+                        continue
+
+                    sys.stderr.write(f"[TileDatabaseWriter] {err}, {len(tile_rows) + len(replace_rows)} tiles could not be written\n")
+                    self.number_of_lost_tiles += len(tile_rows) + len(replace_rows)
+                    if self.error is None:
+                        self.error = err
+                    break
+
+            if self.cache_size_limit is not None and len(cache_rows) > 0:
+                try:
+                    self.evict_cached_tiles(db_connection, tile_table)
+                except sqlite3.Error as err:
+                    db_connection.rollback()
+                    sys.stderr.write(f"[TileDatabaseWriter] eviction failed: {err}\n")
+
+            for task in batch:
+                self.task_queue.task_done()
+            for flushed_event in flushed_events:
+                flushed_event.set()
+
+        # move the write-ahead log into the database file, so that the database can be copied as a single file
+        try:
+            db_cursor.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+        except sqlite3.Error:
+            pass
+        db_connection.close()
+
+    def evict_cached_tiles(self, db_connection: sqlite3.Connection, tile_table: TileTable):
+        """ delete least recently used cached tiles until their total size is 90% of cache_size_limit """
+
+        cache_size = tile_table.get_cache_size()
+        if cache_size <= self.cache_size_limit:
+            return
+
+        while cache_size > self.cache_size_limit * 0.9:
+            oldest_tiles = tile_table.get_least_recently_used_tiles(100)
+            if len(oldest_tiles) == 0:
+                break
+
+            evicted_keys = []
+            for zoom, x, y, server, size in oldest_tiles:
+                if cache_size <= self.cache_size_limit * 0.9:
+                    break
+                evicted_keys.append((zoom, x, y, server))
+                cache_size -= size
+
+            tile_table.delete_tiles(evicted_keys)
+            db_connection.commit()
+            self.number_of_evicted_tiles += len(evicted_keys)
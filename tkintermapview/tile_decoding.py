@@ -0,0 +1,80 @@
+import io
+from PIL import Image, UnidentifiedImageError
+from typing import List, Tuple, Union
+
+
+def decode_tile_image(image_data: bytes, overlays: List[Tuple[Union[bytes, None], float]]) -> Image.Image:
+    """ decodes tile data to a PIL image and draws the overlay tiles [(overlay_image_data, opacity), ...] over it in order,
+        runs in the decode thread or process pool, raises PIL.UnidentifiedImageError if image_data is no image,
+        overlay tiles which are missing or no image are skipped """
+
+    image = Image.open(io.BytesIO(image_data))
+    image.load()
+
+    for overlay_image_data, opacity in overlays:
+        if overlay_image_data is None or opacity <= 0:
+            continue
+
+        try:
+            image_overlay = Image.open(io.BytesIO(overlay_image_data)).convert("RGBA")
+        except (UnidentifiedImageError, OSError):
+            continue
+
+        if image.mode != "RGBA":
+            image = image.convert("RGBA")
+        if image_overlay.size != image.size:
+            image_overlay = image_overlay.resize(image.size, Image.LANCZOS)
+        if opacity < 1:
+            image_overlay.putalpha(image_overlay.getchannel("A").point(lambda alpha: round(alpha * opacity)))
+
+        image.alpha_composite(image_overlay)
+
+    return image
+
+
+def crop_ancestor_tile(ancestor_image: Image.Image, zoom_difference: int, x: int, y: int, tile_size: int) -> Image.Image:
+    """ cuts the part of tile (x, y) out of its ancestor tile (zoom_difference levels above) and scales it up to tile_size """
+
+    factor = 2 ** zoom_difference
+    part_width, part_height = ancestor_image.width / factor, ancestor_image.height / factor
+    left, upper = (x % factor) * part_width, (y % factor) * part_height
+
+    return ancestor_image.crop((round(left), round(upper), round(left + part_width), round(upper + part_height))) \
+        .resize((tile_size, tile_size), Image.BILINEAR)
+
+
+def combine_child_tiles(child_images: dict, tile_size: int, background_color: tuple) -> Image.Image:
+    """ combines the four child tiles {(0, 0): image, (1, 0): image, ...} one zoom level below to one tile of tile_size,
+        missing children are filled with background_color """
+
+    image = Image.new("RGB", (tile_size * 2, tile_size * 2), background_color)
+    for (child_x, child_y), child_image in child_images.items():
+        child_image = child_image.convert("RGBA")
+        if child_image.size != (tile_size, tile_size):
+            child_image = child_image.resize((tile_size, tile_size), Image.BILINEAR)
+        image.paste(child_image, (child_x * tile_size, child_y * tile_size), child_image)
+
+    return image.resize((tile_size, tile_size), Image.BILINEAR)
+
+
+def load_source_image(source: Union[Image.Image, bytes]) -> Image.Image:
+    """ decoded PIL image of a placeholder source, which is a decoded image or encoded tile data """
+
+    if isinstance(source, Image.Image):
+        return source
+
+    image = Image.open(io.BytesIO(source))
+    image.load()
+    return image
+
+
+def decode_placeholder_image(tile_size: int, ancestor: Union[Image.Image, bytes, None], zoom_difference: int, x: int, y: int,
+                             children: dict, background_color: tuple) -> Image.Image:
+    """ placeholder for tile (x, y), the scaled up part of its ancestor zoom_difference levels above, or if ancestor is None
+        the combined child tiles {(0, 0): child, ...} one zoom level below, the sources are decoded images or encoded tile data,
+        runs in the decode thread or process pool """
+
+    if ancestor is not None:
+        return crop_ancestor_tile(load_source_image(ancestor), zoom_difference, x, y, tile_size)
+
+    return combine_child_tiles({position: load_source_image(child) for position, child in children.items()}, tile_size, background_color)
@@ -0,0 +1,153 @@
+import random
+import threading
+import time
+from typing import Dict, Hashable, Tuple
+
+
+class TileFailureTracker:
+    """ remembers failed tile requests, so that failing tiles and unreachable servers are not requested again on every redraw
+
+        - missing tiles (404, 410 or no image) are kept in a negative cache for negative_cache_ttl seconds
+        - other failures (timeouts, connection errors, 429, 5xx) are retried after an exponential backoff with jitter
+        - after failure_threshold failures in a row the circuit breaker of the server opens, and no requests are made for
+          open_time seconds, then a single probe request decides if the server is available again """
+
+    def __init__(self,
+                 negative_cache_ttl: float = 60 * 60,
+                 base_backoff: float = 1.0,
+                 max_backoff: float = 5 * 60,
+                 failure_threshold: int = 5,
+                 open_time: float = 30):
+        self.negative_cache_ttl = negative_cache_ttl
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.open_time = open_time
+
+        self.missing_tiles: Dict[Hashable, float] = {}  # key: tile key, value: expiry time
+        self.failed_tiles: Dict[Hashable, Tuple[int, float]] = {}  # key: tile key, value: (number of failures, retry time)
+        self.servers: Dict[str, list] = {}  # key: server key, value: [failures in a row, open until time, probe running]
+        self.lock = threading.Lock()
+
+        self.number_of_failures = 0
+        self.number_of_skipped_requests = 0
+
+    def get_backoff_time(self, number_of_failures: int) -> float:
+        """ exponential backoff, with a random jitter of +-50 percent, so that failed tiles are not retried all at once """
+
+        backoff_time = min(self.max_backoff, self.base_backoff * 2 ** (number_of_failures - 1))
+        return backoff_time * random.uniform(0.5, 1.5)
+
+    def is_request_allowed(self, tile_key: Hashable, server_key: str) -> bool:
+        """ False if the tile is in the negative cache, waits for its next retry or the server is unavailable """
+
+        now = time.time()
+        with self.lock:
+            expiry_time = self.missing_tiles.get(tile_key)
+            if expiry_time is not None:
+                if expiry_time > now:
+                    self.number_of_skipped_requests += 1
+                    return False
+                del self.missing_tiles[tile_key]
+
+            failure = self.failed_tiles.get(tile_key)
+            if failure is not None and failure[1] > now:
+                self.number_of_skipped_requests += 1
+                return False
+
+            server = self.servers.get(server_key)
+            if server is not None and server[0] >= self.failure_threshold:
+                # open circuit breaker: let one probe request through after open_time
+                if server[1] > now or server[2]:
+                    self.number_of_skipped_requests += 1
+                    return False
+                server[2] = True
+
+            return True
+
+    def is_tile_missing(self, tile_key: Hashable) -> bool:
+        """ True if the tile is in the negative cache """
+
+        with self.lock:
+            return self.missing_tiles.get(tile_key, 0) > time.time()
+
+    def get_retry_time(self, tile_key: Hashable, server_key: str) -> float:
+        """ time when the tile may be requested again, because its backoff is over or the circuit breaker of the server lets a probe through """
+
+        now = time.time()
+        with self.lock:
+            retry_time = self.failed_tiles.get(tile_key, (0, now))[1]
+
+            server = self.servers.get(server_key)
+            if server is not None and server[0] >= self.failure_threshold:
+                # while a probe request is running, wait for its result
+                retry_time = max(retry_time, server[1], now + self.base_backoff if server[2] else now)
+
+            return max(retry_time, now)
+
+    def get_number_of_failures(self, tile_key: Hashable) -> int:
+        with self.lock:
+            return self.failed_tiles.get(tile_key, (0, 0))[0]
+
+    def is_server_available(self, server_key: str) -> bool:
+        with self.lock:
+            server = self.servers.get(server_key)
+            return server is None or server[0] < self.failure_threshold or (server[1] <= time.time() and not server[2])
+
+    def record_success(self, tile_key: Hashable, server_key: str):
+        with self.lock:
+            self.failed_tiles.pop(tile_key, None)
+            self.servers.pop(server_key, None)
+
+    def record_missing(self, tile_key: Hashable, server_key: str):
+        """ tile does not exist on the server, the server itself is reachable """
+
+        with self.lock:
+            self.missing_tiles[tile_key] = time.time() + self.negative_cache_ttl
+            self.failed_tiles.pop(tile_key, None)
+            self.servers.pop(server_key, None)
+
+            if len(self.missing_tiles) > 10000:
+                self.remove_expired_tiles()
+
+    def record_failure(self, tile_key: Hashable, server_key: str) -> float:
+        """ returns the number of seconds until the tile may be requested again """
+
+        now = time.time()
+        with self.lock:
+            number_of_failures = self.failed_tiles.get(tile_key, (0, 0))[0] + 1
+            backoff_time = self.get_backoff_time(number_of_failures)
+            self.failed_tiles[tile_key] = (number_of_failures, now + backoff_time)
+            self.number_of_failures += 1
+
+            if len(self.failed_tiles) > 10000:
+                self.remove_expired_tiles()
+
+            server = self.servers.setdefault(server_key, [0, 0, False])
+            server[0] += 1
+            server[2] = False
+            if server[0] >= self.failure_threshold:
+                server[1] = now + self.open_time
+
+            return backoff_time
+
+    def remove_expired_tiles(self):
+        """ forget missing tiles whose negative cache entry expired and failed tiles that may be retried, lock must be held """
+
+        now = time.time()
+        self.missing_tiles = {key: expiry_time for key, expiry_time in self.missing_tiles.items() if expiry_time > now}
+        self.failed_tiles = {key: failure for key, failure in self.failed_tiles.items() if failure[1] > now}
+
+    def clear(self):
+        with self.lock:
+            self.missing_tiles.clear()
+            self.failed_tiles.clear()
+            self.servers.clear()
+
+    def get_statistics(self) -> Dict[str, int]:
+        with self.lock:
+            return {"missing_tiles": len(self.missing_tiles),
+                    "failed_tiles": len(self.failed_tiles),
+                    "unavailable_servers": sum(1 for server in self.servers.values() if server[0] >= self.failure_threshold),
+                    "failures": self.number_of_failures,
+                    "skipped_requests": self.number_of_skipped_requests}
@@ -0,0 +1,41 @@
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .map_widget import TkinterMapView
+
+
+class TileLayer:
+    """ overlay tile server which is drawn over the map tiles, layers are drawn in the order they were added,
+        its tiles are loaded in parallel with the map tiles and cached separately, so that changing the visibility
+        or opacity of a layer only needs a new composite of cached tiles """
+
+    def __init__(self,
+                 map_widget: "TkinterMapView",
+                 tile_server: str,
+                 opacity: float = 1.0,
+                 visible: bool = True,
+                 name: str = None):
+
+        self.map_widget = map_widget
+        self.tile_server = tile_server
+        self.opacity = opacity
+        self.visible = visible
+        self.name = name
+        self.deleted = False
+
+    def delete(self):
+        if self in self.map_widget.overlay_layers:
+            self.map_widget.overlay_layers.remove(self)
+
+        self.deleted = True
+        self.map_widget.update_tile_layers()
+
+    def set_opacity(self, opacity: float):
+        """ opacity between 0 (transparent) and 1 """
+
+        self.opacity = max(0.0, min(1.0, opacity))
+        self.map_widget.update_tile_layers()
+
+    def set_visible(self, visible: bool):
+        self.visible = visible
+        self.map_widget.update_tile_layers()
@@ -0,0 +1,83 @@
+import heapq
+import itertools
+import threading
+from typing import Callable, Union
+
+
+class TileLoadQueue:
+    """ blocking priority queue for the tile loader threads, idle threads sleep until a task arrives
+
+        priority_function(task) returns a sortable priority (lowest is loaded first),
+        stale_function(task) returns True if a task is outdated and should be dropped without loading it """
+
+    def __init__(self, priority_function: Callable = None, stale_function: Callable = None):
+        self.priority_function = priority_function
+        self.stale_function = stale_function
+
+        self.heap = []  # entries: (priority, sequence_number, task)
+        self.sequence_counter = itertools.count()  # keeps order of insertion for tasks with equal priority
+        self.condition = threading.Condition()
+        self.closed = False
+
+        self.number_of_dropped_tasks = 0
+        self.number_of_cancelled_tasks = 0  # tasks removed with discard or clear
+
+    def __len__(self):
+        return len(self.heap)
+
+    def get_priority(self, task):
+        if self.priority_function is None:
+            return 0
+        return self.priority_function(task)
+
+    def put(self, task):
+        with self.condition:
+            heapq.heappush(self.heap, (self.get_priority(task), next(self.sequence_counter), task))
+            self.condition.notify()
+
+    def get(self) -> Union[tuple, None]:
+        """ blocks until a task is available, returns None if the queue got closed """
+
+        with self.condition:
+            while True:
+                while len(self.heap) == 0 and not self.closed:
+                    self.condition.wait()
+
+                if self.closed:
+                    return None
+
+                task = heapq.heappop(self.heap)[2]
+                if self.stale_function is not None and self.stale_function(task):
+                    self.number_of_dropped_tasks += 1
+                    continue
+
+                return task
+
+    def reprioritize(self):
+        """ recalculate the priority of all waiting tasks, for example after the map moved """
+
+        with self.condition:
+            self.heap = [(self.get_priority(task), sequence_number, task) for _, sequence_number, task in self.heap]
+            heapq.heapify(self.heap)
+
+    def discard(self, predicate: Callable):
+        """ remove all waiting tasks for which predicate(task) is True """
+
+        with self.condition:
+            number_of_tasks = len(self.heap)
+            self.heap = [entry for entry in self.heap if not predicate(entry[2])]
+            heapq.heapify(self.heap)
+            self.number_of_cancelled_tasks += number_of_tasks - len(self.heap)
+
+    def clear(self):
+        with self.condition:
+            self.number_of_cancelled_tasks += len(self.heap)
+            self.heap = []
+
+    def close(self):
+        """ wakes up all waiting threads and lets them return None """
+
+        with self.condition:
+            self.closed = True
+            self.heap = []
+            self.condition.notify_all()
@@ -0,0 +1,154 @@
+import sqlite3
+import threading
+import queue
+import time
+import sys
+from typing import Callable, Dict, List, Union
+
+from .tile_session import TileSessionPool, get_expiry_time, get_validation_headers, is_image_response
+from .tile_database import TileDatabaseWriter, TileTable
+from .tile_url import TileUrlTemplate
+
+
+class TileRefresher:
+    """ revalidates stored tiles in background threads with conditional requests (ETag / Last-Modified),
+        unchanged tiles only cost a 304 response, changed tiles are replaced in the database
+
+        refresh_callback(zoom, x, y, server) gets called from a background thread after a tile was replaced,
+        url_templates maps servers to their compiled TileUrlTemplate, other servers are compiled with the default subdomains """
+
+    def __init__(self, db_path: str,
+                 session_pool: TileSessionPool,
+                 database_writer: TileDatabaseWriter,
+                 default_ttl: float = 7 * 24 * 60 * 60,
+                 number_of_threads: int = 4,
+                 refresh_callback: Union[Callable, None] = None,
+                 url_templates: Union[Dict[str, TileUrlTemplate], None] = None):
+        self.db_path = db_path
+        self.session_pool = session_pool
+        self.database_writer = database_writer
+        self.default_ttl = default_ttl
+        self.refresh_callback = refresh_callback
+        self.url_templates = url_templates if url_templates is not None else {}
+
+        self.task_queue = queue.Queue(maxsize=1000)  # task: (zoom, x, y, server, etag, last_modified)
+        self.pending_tiles = set()  # (zoom, x, y, server) of tasks in task_queue, so that no tile is revalidated twice
+        self.lock = threading.Lock()
+        self.running = True
+
+        self.number_of_not_modified_tiles = 0
+        self.number_of_replaced_tiles = 0
+        self.number_of_failed_tiles = 0
+
+        self.thread_pool: List[threading.Thread] = []
+        for i in range(number_of_threads):
+            thread = threading.Thread(daemon=True, target=self.refresh_tiles_background)
+            thread.start()
+            self.thread_pool.append(thread)
+
+    def revalidate_tile(self, zoom: int, x: int, y: int, server: str, etag: Union[str, None], last_modified: Union[str, None],
+                        block: bool = False):
+        """ schedule revalidation of a stored tile, without block the tile is skipped if too many tiles are waiting """
+
+        with self.lock:
+            if not self.running or (zoom, x, y, server) in self.pending_tiles:
+                return
+            self.pending_tiles.add((zoom, x, y, server))
+
+        try:
+            self.task_queue.put((zoom, x, y, server, etag, last_modified), block=block)
+        except queue.Full:
+            with self.lock:
+                self.pending_tiles.discard((zoom, x, y, server))
+
+    def refresh_stale_tiles(self, server: str, blocking: bool = False):
+        """ revalidate all expired tiles of server in the database, and tiles without validation data,
+            runs in a background thread unless blocking is True """
+
+        if blocking:
+            self.refresh_stale_tiles_background(server)
+            self.task_queue.join()
+        else:
+            threading.Thread(daemon=True, target=self.refresh_stale_tiles_background, args=(server,)).start()
+
+    def refresh_stale_tiles_background(self, server: str):
+        db_connection = sqlite3.connect(self.db_path, timeout=30)
+        tile_table = TileTable(db_connection.cursor())
+
+        refresh_time = time.time()
+        last_key = (-1, -1, -1)
+
+        # read stale tiles in chunks, so that the database is not locked for the writer while waiting for the bounded task_queue
+        while self.running:
+            stale_tiles = tile_table.get_stale_tiles(server, last_key, refresh_time, limit=500)
+            if len(stale_tiles) == 0:
+                break
+
+            for zoom, x, y, etag, last_modified in stale_tiles:
+                self.revalidate_tile(zoom, x, y, server, etag, last_modified, block=True)
+            last_key = stale_tiles[-1][:3]
+
+        db_connection.close()
+
+    def close(self):
+        """ stops the refresh threads, waiting tiles are not revalidated, requests which are running are finished
+            but their results are not stored anymore """
+
+        with self.lock:
+            self.running = False
+            self.pending_tiles.clear()
+
+        # drop waiting tasks, so that the stop signals fit into the queue and blocked refresh_stale_tiles calls return
+        while True:
+            try:
+                self.task_queue.get_nowait()
+                self.task_queue.task_done()
+            except queue.Empty:
+                break
+        for thread in self.thread_pool:
+            self.task_queue.put(None)
+
+    def refresh_tiles_background(self):
+        while True:
+            task = self.task_queue.get()
+            if task is None:
+                self.task_queue.task_done()
+                break
+            zoom, x, y, server, etag, last_modified = task
+
+            try:
+                url_template = self.url_templates.get(server)
+                if url_template is None:
+                    url_template = self.url_templates.setdefault(server, TileUrlTemplate(server))
+                url = url_template.get_url(zoom, x, y)
+                response = self.session_pool.get(url, throttle_key=TileSessionPool.get_server_key(server),
+                                                 headers=get_validation_headers(etag, last_modified))
+                expires = get_expiry_time(response.headers, self.default_ttl)
+
+                if not self.running:
+                    pass  # closed while the request was running
+                elif response.status_code == 304:
+                    # tile didn't change, only store the new expiry time
+                    self.database_writer.update_tile_validation(zoom, x, y, server, (response.headers.get("ETag", etag),
+                                                                                     response.headers.get("Last-Modified", last_modified),
+                                                                                     expires))
+                    self.number_of_not_modified_tiles += 1
+
+                elif response.status_code == 200 and len(response.content) > 0 and is_image_response(response.headers):
+                    self.database_writer.insert_tile(zoom, x, y, server, response.content, replace=True,
+                                                     validation=(response.headers.get("ETag"), response.headers.get("Last-Modified"), expires))
+                    self.number_of_replaced_tiles += 1
+
+                    if self.refresh_callback is not None:
+                        self.refresh_callback(zoom, x, y, server)
+                else:
+                    self.number_of_failed_tiles += 1
+
+            except Exception as err:
+                sys.stderr.write(f"[TileRefresher] {err}\n")
+                self.number_of_failed_tiles += 1
+
+            finally:
+                with self.lock:
+                    self.pending_tiles.discard((zoom, x, y, server))
+                self.task_queue.task_done()
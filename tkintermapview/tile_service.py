@@ -0,0 +1,352 @@
+import sqlite3
+import threading
+import time
+import sys
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import TYPE_CHECKING, Callable, Dict, List, Union
+
+if TYPE_CHECKING:
+    from .map_widget import TkinterMapView
+
+from .tile_session import TileSessionPool, get_default_session_pool, get_expiry_time, is_image_response
+from .tile_load_queue import TileLoadQueue
+from .in_flight_registry import InFlightRegistry
+from .tile_database import TileDatabaseWriter, TileTable
+from .tile_refresh import TileRefresher
+from .tile_cache import TileImageCache
+from .tile_failures import TileFailureTracker
+from .tile_url import TileUrlTemplate
+from .mbtiles import MBTilesSource, get_mbtiles_path
+
+
+class TileService:
+    """ tile loading pipeline of TkinterMapView: loader threads, decode pool, tile data cache, in-flight request coalescing,
+        failure tracking and database handles
+
+        every widget creates its own TileService by default, pass the same TileService as tile_service to several widgets
+        to share it, so that tiles they have in common are only downloaded and stored once,
+        every widget keeps its own viewport, task priorities and decoded image cache """
+
+    def __init__(self,
+                 database_path: str = None,
+                 use_database_only: bool = False,
+                 persistent_tile_cache: bool = False,
+                 tile_cache_size_limit: int = 500 * 1024 ** 2,
+                 default_tile_ttl: float = 7 * 24 * 60 * 60,
+                 tile_data_cache_size_limit: int = 256 * 1024 ** 2,
+                 session_pool: TileSessionPool = None,
+                 tile_loader_threads: int = 25,
+                 decode_workers: int = 2,
+                 decode_in_processes: bool = False,
+                 negative_cache_ttl: float = 60 * 60):
+
+        self.running = True
+
+        self.database_path = database_path
+        self.use_database_only = use_database_only
+        self.default_tile_ttl = default_tile_ttl  # seconds until a stored tile expires, if the server sends no caching headers
+        self.tile_url_templates: Dict[str, TileUrlTemplate] = {}  # key: server
+        self.mbtiles_sources: Dict[str, MBTilesSource] = {}  # key: path, for tile servers with mbtiles:// url
+
+        # keep-alive HTTP connections for tile requests, shared with other services and loaders by default
+        self.session_pool = session_pool if session_pool is not None else get_default_session_pool()
+
+        # missing tiles are not requested again for negative_cache_ttl seconds, failed tiles are retried with exponential backoff,
+        # and if a server is unreachable, only tiles from the database and the caches are shown until it is available again
+        self.tile_failures = TileFailureTracker(negative_cache_ttl=negative_cache_ttl)
+
+        # encoded tile data of all tile servers and layers, ~10x smaller than decoded images
+        self.tile_data_cache = TileImageCache(tile_data_cache_size_limit)  # key: (server, zoom, x, y)
+        self.in_flight_requests = InFlightRegistry()  # concurrent requests for the same tile share one download
+
+        # write-through cache, tiles loaded from the server get stored in the database for the next sessions,
+        # expired tiles are shown immediately and revalidated in the background
+        if persistent_tile_cache:
+            if database_path is None:
+                raise ValueError("persistent_tile_cache needs a database_path")
+            self.tile_database_writer: Union[TileDatabaseWriter, None] = TileDatabaseWriter(database_path, cache_size_limit=tile_cache_size_limit)
+            self.tile_refresher: Union[TileRefresher, None] = TileRefresher(database_path, self.session_pool, self.tile_database_writer,
+                                                                            default_ttl=default_tile_ttl, refresh_callback=self.tile_refreshed,
+                                                                            url_templates=self.tile_url_templates)
+        else:
+            self.tile_database_writer: Union[TileDatabaseWriter, None] = None
+            self.tile_refresher: Union[TileRefresher, None] = None
+
+        self.widgets: List["TkinterMapView"] = []  # attached widgets
+        self.lock = threading.Lock()
+
+        # tasks of all attached widgets, every widget decides about the priority and staleness of its own tasks
+        self.task_queue = TileLoadQueue(priority_function=lambda entry: entry[0].get_tile_load_priority(entry[1]),
+                                        stale_function=lambda entry: entry[0].is_tile_load_task_stale(entry[1]))  # entry: (widget, task)
+
+        # tile loading pipeline: loader threads fetch tile data -> decode pool decodes it to PIL images
+        # -> main thread of the widget creates the PhotoImages
+        if decode_in_processes:
+            self.decode_executor = ProcessPoolExecutor(max_workers=decode_workers)
+        else:
+            self.decode_executor = ThreadPoolExecutor(max_workers=decode_workers)
+
+        # overlay layer tiles are loaded in parallel to the map tile, every thread has its own database connection
+        self.layer_load_executor = ThreadPoolExecutor(max_workers=tile_loader_threads)
+        self.thread_data = threading.local()
+        self.database_connections: List[sqlite3.Connection] = []  # connections of all threads, closed by close()
+
+        # add background threads which load tiles from self.task_queue
+        self.thread_pool: List[threading.Thread] = []
+        for i in range(tile_loader_threads):
+            thread = threading.Thread(daemon=True, target=self.load_tiles_background)
+            thread.start()
+            self.thread_pool.append(thread)
+
+    def attach(self, widget: "TkinterMapView") -> "WidgetTaskQueue":
+        """ returns the task queue of widget, its tasks are loaded by the loader threads of this service """
+
+        with self.lock:
+            self.widgets.append(widget)
+        return WidgetTaskQueue(self.task_queue, widget)
+
+    def detach(self, widget: "TkinterMapView"):
+        with self.lock:
+            if widget in self.widgets:
+                self.widgets.remove(widget)
+
+    def close(self):
+        """ stops the loader threads and pools and commits tiles that are not written to the database yet """
+
+        self.running = False
+        self.task_queue.close()
+        self.decode_executor.shutdown(wait=False)
+        self.layer_load_executor.shutdown(wait=False)
+
+        if self.tile_refresher is not None:
+            self.tile_refresher.close()
+
+        if self.tile_database_writer is not None:
+            try:
+                self.tile_database_writer.close()
+            except sqlite3.Error:
+                pass  # already reported by the writer, the cached tiles are only lost for the next start
+
+        with self.lock:
+            for mbtiles_source in self.mbtiles_sources.values():
+                mbtiles_source.close()
+            for db_connection in self.database_connections:
+                db_connection.close()
+            self.database_connections.clear()
+
+    def set_url_template(self, server: str, subdomains: str = "abc"):
+        self.tile_url_templates[server] = TileUrlTemplate(server, subdomains)
+
+    def get_tile_url_template(self, server: str) -> TileUrlTemplate:
+        template = self.tile_url_templates.get(server)
+        if template is None:
+            template = self.tile_url_templates.setdefault(server, TileUrlTemplate(server))
+        return template
+
+    def get_mbtiles_source(self, path: str) -> MBTilesSource:
+        with self.lock:
+            mbtiles_source = self.mbtiles_sources.get(path)
+            if mbtiles_source is None:
+                mbtiles_source = self.mbtiles_sources[path] = MBTilesSource(path)
+            return mbtiles_source
+
+    def get_tile_table(self) -> Union[TileTable, None]:
+        """ tiles of the database for the calling thread, every thread has its own connection, None if there is no database """
+
+        tile_table = getattr(self.thread_data, "tile_table", None)
+        if tile_table is None and self.database_path is not None:
+            db_connection = sqlite3.connect(self.database_path, check_same_thread=False)
+            with self.lock:
+                self.database_connections.append(db_connection)
+            tile_table = TileTable(db_connection.cursor())
+            self.thread_data.tile_table = tile_table
+        return tile_table
+
+    def load_tiles_background(self):
+        while self.running:
+            # blocks until a task is available, returns None when the service gets closed
+            entry = self.task_queue.get()
+            if entry is None:
+                break
+
+            widget, task = entry
+            try:
+                widget.load_tile(task, tile_table=self.get_tile_table())
+            except Exception as err:
+                if self.running:  # otherwise the database connection was closed by close()
+                    sys.stderr.write(f"[TileService] {err}\n")
+
+    def request_layer_tile_data(self, server: str, zoom: int, x: int, y: int) -> Union[bytes, None]:
+        """ runs in the layer load pool, returns the tile data of an overlay layer """
+
+        return self.request_tile_data(server, zoom, x, y, tile_table=self.get_tile_table())
+
+    def request_tile_data(self, server: str, zoom: int, x: int, y: int, tile_table: TileTable = None) -> Union[bytes, None]:
+        """ returns encoded tile data from the tile data cache, the database or the server, None if the tile could not be loaded,
+            if the same tile is already loaded by another thread, wait for that thread and use its result instead of loading the tile twice """
+
+        if self.tile_failures.is_tile_missing((server, zoom, x, y)):
+            return None
+
+        image_data = self.tile_data_cache.get((server, zoom, x, y))
+        if image_data is not None:
+            return image_data
+
+        return self.in_flight_requests.run((server, zoom, x, y), self._request_tile_data, server, zoom, x, y, tile_table=tile_table)
+
+    def _request_tile_data(self, server: str, zoom: int, x: int, y: int, tile_table: TileTable = None) -> Union[bytes, None]:
+        # tiles of an MBTiles file are read directly from the file
+        mbtiles_path = get_mbtiles_path(server)
+        if mbtiles_path is not None:
+            try:
+                image_data = self.get_mbtiles_source(mbtiles_path).get_tile(zoom, x, y)
+            except sqlite3.Error as err:
+                sys.stderr.write(f"[TileService] {err}\n")
+                return None
+            if image_data is not None:
+                self.tile_data_cache.put((server, zoom, x, y), image_data, len(image_data))
+            return image_data
+
+        server_key = TileSessionPool.get_server_key(server)
+
+        # if database is available check first if tile is in database, if not try to use server
+        if tile_table is not None:
+            try:
+                image_data = tile_table.get_tile(zoom, x, y, server)
+
+                if image_data is not None:
+                    self.tile_data_cache.put((server, zoom, x, y), image_data, len(image_data))
+
+                    if self.tile_database_writer is not None:
+                        self.tile_database_writer.touch_tile(zoom, x, y, server)
+
+                    # use expired tile anyway and revalidate it in the background
+                    if self.tile_refresher is not None and not self.use_database_only:
+                        validation = tile_table.get_tile_validation(zoom, x, y, server)
+                        if validation is not None and validation[2] < time.time() and self.tile_failures.is_server_available(server_key):
+                            self.tile_refresher.revalidate_tile(zoom, x, y, server, validation[0], validation[1])
+                    return image_data
+                elif self.use_database_only:
+                    return None
+                else:
+                    pass
+
+            except sqlite3.OperationalError:
+                if self.use_database_only:
+                    return None
+                else:
+                    pass
+
+            except Exception:
+                return None
+
+        # skip tiles that are missing or failed a short time ago, and servers that are unreachable
+        if not self.tile_failures.is_request_allowed((server, zoom, x, y), server_key):
+            return None
+
+        # try to get the tile from the server
+        try:
+            url = self.get_tile_url_template(server).get_url(zoom, x, y)
+            response = self.session_pool.get(url, throttle_key=server_key)
+            image_data = response.content
+
+        except Exception:  # timeout or connection error
+            self.tile_failures.record_failure((server, zoom, x, y), server_key)
+            return None
+
+        if response.status_code in (204, 404, 410) or (response.status_code == 200 and len(image_data) == 0):
+            self.tile_failures.record_missing((server, zoom, x, y), server_key)
+            return None
+        elif response.status_code != 200 or not is_image_response(response.headers):
+            # error pages with status 200 are not cached, they are retried after a backoff
+            self.tile_failures.record_failure((server, zoom, x, y), server_key)
+            return None
+
+        self.tile_failures.record_success((server, zoom, x, y), server_key)
+
+        if self.running:
+            self.tile_data_cache.put((server, zoom, x, y), image_data, len(image_data))
+
+            if self.tile_database_writer is not None:
+                self.tile_database_writer.insert_tile(zoom, x, y, server, image_data, cache=True,
+                                                      validation=(response.headers.get("ETag"), response.headers.get("Last-Modified"),
+                                                                  get_expiry_time(response.headers, self.default_tile_ttl)))
+        return image_data
+
+    def remove_tile(self, zoom: int, x: int, y: int, server: str):
+        """ remove a tile whose data is no image from the tile data cache and the database """
+
+        self.tile_data_cache.remove((server, zoom, x, y))
+        if self.tile_database_writer is not None:
+            self.tile_database_writer.delete_tile(zoom, x, y, server)
+
+    def tile_refreshed(self, zoom: int, x: int, y: int, server: str):
+        """ called by the tile refresher thread when a tile changed on the server, the new tile gets loaded on the next draw """
+
+        self.tile_data_cache.remove((server, zoom, x, y))
+
+        with self.lock:
+            widgets = list(self.widgets)
+        for widget in widgets:
+            widget.tile_refreshed(zoom, x, y, server)
+
+    def refresh_stale_tiles(self, server: str):
+        """ revalidate all expired tiles of server in the database in the background, needs persistent_tile_cache=True """
+
+        if self.tile_refresher is None:
+            raise ValueError("refresh_stale_tiles needs persistent_tile_cache=True")
+        self.tile_refresher.refresh_stale_tiles(server)
+
+    def get_statistics(self) -> dict:
+        """ returns counters of the shared part of the tile loading pipeline """
+
+        return {"queued_tasks": len(self.task_queue),
+                "dropped_stale_tasks": self.task_queue.number_of_dropped_tasks,
+                "cancelled_tasks": self.task_queue.number_of_cancelled_tasks,
+                "attached_widgets": len(self.widgets),
+                "in_flight": self.in_flight_requests.get_statistics(),
+                "failures": self.tile_failures.get_statistics(),
+                "data_cache": self.tile_data_cache.get_statistics(),
+                "database_written_tiles": self.tile_database_writer.number_of_written_tiles if self.tile_database_writer is not None else 0,
+                "database_evicted_tiles": self.tile_database_writer.number_of_evicted_tiles if self.tile_database_writer is not None else 0,
+                "database_lost_tiles": self.tile_database_writer.number_of_lost_tiles if self.tile_database_writer is not None else 0,
+                "connections": self.session_pool.get_statistics()}
+
+
+class WidgetTaskQueue:
+    """ the tasks of one widget in the task queue of a TileService, has the interface of TileLoadQueue for the widget,
+        entries in the shared queue are (widget, task) """
+
+    def __init__(self, task_queue: TileLoadQueue, widget: "TkinterMapView"):
+        self.task_queue = task_queue
+        self.widget = widget
+        self.closed = False
+
+    def __len__(self):
+        with self.task_queue.condition:
+            return sum(1 for entry in self.task_queue.heap if entry[2][0] is self.widget)
+
+    @property
+    def number_of_dropped_tasks(self) -> int:
+        return self.task_queue.number_of_dropped_tasks
+
+    @property
+    def number_of_cancelled_tasks(self) -> int:
+        return self.task_queue.number_of_cancelled_tasks
+
+    def put(self, task):
+        if not self.closed:
+            self.task_queue.put((self.widget, task))
+
+    def reprioritize(self):
+        self.task_queue.reprioritize()
+
+    def discard(self, predicate: Callable):
+        self.task_queue.discard(lambda entry: entry[0] is self.widget and predicate(entry[1]))
+
+    def clear(self):
+        self.discard(lambda task: True)
+
+    def close(self):
+        self.closed = True
+        self.clear()
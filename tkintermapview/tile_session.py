@@ -0,0 +1,242 @@
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlsplit
+from email.utils import parsedate_to_datetime
+from typing import Dict, Union
+
+from .tile_throttling import TokenBucket, AdaptiveConcurrencyLimiter
+
+
+class TileSessionPool:
+    """ thread-safe pool of keep-alive HTTP sessions, one session per tile server host,
+        connect_timeout and read_timeout (seconds) keep a stalled server from blocking the loader threads forever
+
+        requests to each tile server are throttled, so that tile servers don't get bursts of requests,
+        the throttle is shared by all hosts of a server with {s} subdomains if the caller passes the same throttle_key:
+        requests_per_second and bytes_per_second limit the rate with token buckets (None means unlimited),
+        and the number of concurrent requests adapts between 1 and pool_size to the latency and 429/503 responses,
+        starting at initial_concurrency (adaptive_concurrency=False allows pool_size concurrent requests) """
+
+    def __init__(self,
+                 pool_size: int = 50,
+                 max_retries: int = 0,
+                 backoff_factor: float = 0.0,
+                 user_agent: str = "TkinterMapView",
+                 connect_timeout: float = 5.0,
+                 read_timeout: float = 15.0,
+                 requests_per_second: Union[float, None] = None,
+                 bytes_per_second: Union[float, None] = None,
+                 adaptive_concurrency: bool = True,
+                 initial_concurrency: int = 8):
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.user_agent = user_agent
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.requests_per_second = requests_per_second
+        self.bytes_per_second = bytes_per_second
+        self.adaptive_concurrency = adaptive_concurrency
+        self.initial_concurrency = initial_concurrency
+
+        self.sessions: Dict[str, requests.Session] = {}  # key: "scheme://host[:port]"
+        self.throttles: Dict[str, tuple] = {}  # key: throttle key, value: (request bucket, byte bucket, concurrency limiter)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_server_key(url: str) -> str:
+        split_url = urlsplit(url)
+        return f"{split_url.scheme}://{split_url.netloc}"
+
+    def create_session(self) -> requests.Session:
+        if self.max_retries > 0:
+            retry = Retry(total=self.max_retries,
+                          backoff_factor=self.backoff_factor,
+                          status_forcelist=(429, 500, 502, 503, 504),
+                          raise_on_status=False)
+        else:
+            retry = 0
+
+        # pool_maxsize must be at least the number of threads which use the session at the same time,
+        # otherwise urllib3 throws away surplus connections instead of keeping them alive
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({"User-Agent": self.user_agent})
+        return session
+
+    def get_session(self, url: str) -> requests.Session:
+        server_key = self.get_server_key(url)
+
+        with self.lock:
+            session = self.sessions.get(server_key)
+            if session is None:
+                session = self.create_session()
+                self.sessions[server_key] = session
+            return session
+
+    def get_throttle(self, throttle_key: str) -> tuple:
+        with self.lock:
+            throttle = self.throttles.get(throttle_key)
+            if throttle is None:
+                if self.adaptive_concurrency:
+                    concurrency_limiter = AdaptiveConcurrencyLimiter(initial_limit=min(self.initial_concurrency, self.pool_size),
+                                                                     max_limit=self.pool_size)
+                else:
+                    concurrency_limiter = AdaptiveConcurrencyLimiter(initial_limit=self.pool_size, min_limit=self.pool_size,
+                                                                     max_limit=self.pool_size)
+                throttle = (TokenBucket(self.requests_per_second), TokenBucket(self.bytes_per_second), concurrency_limiter)
+                self.throttles[throttle_key] = throttle
+            return throttle
+
+    def get(self, url: str, throttle_key: str = None, **kwargs) -> requests.Response:
+        """ GET request over a pooled keep-alive connection, the response body is read completely,
+            so that the connection is released back to the pool, blocks while the tile server is throttled,
+            throttle_key identifies the tile server (default: the host of url), for example get_server_key of the url template """
+
+        kwargs.setdefault("timeout", (self.connect_timeout, self.read_timeout))
+        request_bucket, byte_bucket, concurrency_limiter = self.get_throttle(throttle_key if throttle_key is not None else self.get_server_key(url))
+
+        concurrency_limiter.acquire()
+        latency, throttled = None, False
+        try:
+            request_bucket.acquire()
+            byte_bucket.acquire(0)  # wait until the bytes of the last downloads are paid off
+
+            start_time = time.monotonic()
+            response = self.get_session(url).get(url, **kwargs)
+            latency = time.monotonic() - start_time
+
+            byte_bucket.consume(len(response.content))
+
+            if response.status_code in (429, 503):
+                throttled = True
+                retry_after = get_retry_after(response.headers)
+                if retry_after is not None:
+                    request_bucket.pause(min(retry_after, 5 * 60))
+            return response
+        except requests.exceptions.Timeout:
+            throttled = True  # an overloaded server is the most likely reason for a timeout
+            raise
+        finally:
+            concurrency_limiter.release(latency, throttled=throttled)
+
+    def get_statistics(self) -> Dict[str, int]:
+        """ returns the number of requests and how many of them used a new or a reused connection """
+
+        number_of_requests, new_connections = 0, 0
+
+        with self.lock:
+            sessions = list(self.sessions.values())
+
+        for session in sessions:
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for pool_key in pools.keys():
+                    pool = pools.get(pool_key)
+                    if pool is not None:
+                        number_of_requests += pool.num_requests
+                        new_connections += pool.num_connections
+
+        return {"requests": number_of_requests,
+                "new_connections": new_connections,
+                "reused_connections": max(0, number_of_requests - new_connections)}
+
+    def get_throttle_statistics(self) -> Dict[str, dict]:
+        """ returns the current concurrency limit, latency and number of throttled responses per throttle key """
+
+        with self.lock:
+            throttles = dict(self.throttles)
+        return {server_key: throttle[2].get_statistics() for server_key, throttle in throttles.items()}
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+
+
+# process-wide default pool, shared by every TkinterMapView and OfflineLoader that is not given its own pool
+default_session_pool: Union[TileSessionPool, None] = None
+default_session_pool_lock = threading.Lock()
+
+
+def get_default_session_pool() -> TileSessionPool:
+    global default_session_pool
+
+    with default_session_pool_lock:
+        if default_session_pool is None:
+            default_session_pool = TileSessionPool()
+        return default_session_pool
+
+
+def get_expiry_time(headers, default_ttl: float, now: float = None) -> float:
+    """ returns the unix time when a tile expires according to the Cache-Control or Expires response header,
+        or now + default_ttl if the server sends neither of them """
+
+    if now is None:
+        now = time.time()
+
+    cache_control = {}
+    for directive in headers.get("Cache-Control", "").lower().split(","):
+        name, _, value = directive.strip().partition("=")
+        if name:
+            cache_control[name] = value.strip('" ')
+
+    if "no-cache" in cache_control or "no-store" in cache_control:
+        return now
+
+    if "max-age" in cache_control:
+        try:
+            age = float(headers.get("Age", 0))
+            return now + max(0.0, float(cache_control["max-age"]) - age)
+        except ValueError:
+            pass
+
+    if "Expires" in headers:
+        try:
+            return parsedate_to_datetime(headers["Expires"]).timestamp()
+        except (TypeError, ValueError, IndexError):
+            return now  # invalid Expires header means already expired
+
+    return now + default_ttl
+
+
+def is_image_response(headers) -> bool:
+    """ False if the Content-Type header shows that the response is no tile image, for example an HTML error page with status 200,
+        responses without Content-Type and binary data are accepted """
+
+    content_type = headers.get("Content-Type", "image/").split(";")[0].strip().lower()
+    return content_type.startswith("image/") or content_type in ("", "application/octet-stream")
+
+
+def get_retry_after(headers, now: float = None) -> Union[float, None]:
+    """ returns the seconds of the Retry-After response header, which are given as number or as HTTP date,
+        None if there is no valid Retry-After header """
+
+    retry_after = headers.get("Retry-After", "").strip()
+    if retry_after.isdigit():
+        return float(retry_after)
+
+    if retry_after:
+        try:
+            return max(0.0, parsedate_to_datetime(retry_after).timestamp() - (now if now is not None else time.time()))
+        except (TypeError, ValueError, IndexError):
+            return None
+    return None
+
+
+def get_validation_headers(etag: Union[str, None], last_modified: Union[str, None]) -> Dict[str, str]:
+    """ request headers for a conditional request, the server answers 304 Not Modified if the tile didn't change """
+
+    headers = {}
+    if etag is not None:
+        headers["If-None-Match"] = etag
+    if last_modified is not None:
+        headers["If-Modified-Since"] = last_modified
+    return headers
@@ -0,0 +1,133 @@
+import threading
+import time
+from typing import Dict, Union
+
+
+class TokenBucket:
+    """ thread-safe token bucket, rate tokens per second are added up to capacity (default: one second of tokens),
+        a rate of None means unlimited """
+
+    def __init__(self, rate: Union[float, None], capacity: Union[float, None] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else (rate if rate is not None else 0)
+        self.tokens = self.capacity
+        self.last_update_time = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def update_tokens(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_update_time) * self.rate)
+        self.last_update_time = now
+
+    def acquire(self, amount: float = 1):
+        """ blocks until amount tokens are available and takes them, and while the bucket is paused, also with an unlimited rate """
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if self.rate is None:
+                    if now >= self.paused_until:
+                        return
+                    wait_time = self.paused_until - now
+                else:
+                    self.update_tokens(now)
+
+                    if now >= self.paused_until and self.tokens >= min(amount, self.capacity):
+                        self.tokens -= amount
+                        return
+
+                    wait_time = max(self.paused_until - now, (min(amount, self.capacity) - self.tokens) / self.rate)
+            time.sleep(wait_time)
+
+    def consume(self, amount: float):
+        """ takes tokens without waiting, the bucket may go into debt, for example for the bytes of a finished download """
+
+        if self.rate is None:
+            return
+
+        with self.lock:
+            self.update_tokens(time.monotonic())
+            self.tokens -= amount
+
+    def pause(self, seconds: float):
+        """ hand out no tokens for the next seconds, for example after a 429 response with Retry-After header """
+
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class AdaptiveConcurrencyLimiter:
+    """ limits the number of concurrent requests to a server with additive increase / multiplicative decrease (AIMD):
+        the limit grows by one per limit successful requests and is halved when the server throttles (429, 503)
+        or the smoothed latency rises above latency_tolerance times its lowest value of the last baseline_window to
+        2 * baseline_window responses, so that the baseline follows a lasting change of the latency (for example a slower network) """
+
+    def __init__(self, initial_limit: int = 8, min_limit: int = 1, max_limit: int = 50, latency_tolerance: float = 3.0,
+                 baseline_window: int = 100):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.baseline_window = baseline_window
+
+        self.active_requests = 0
+        self.min_latency: Union[float, None] = None
+        self.window_min_latency: Union[float, None] = None  # lowest smoothed latency of the current window
+        self.number_of_window_samples = 0
+        self.smoothed_latency: Union[float, None] = None
+        self.last_decrease_time = 0.0
+        self.condition = threading.Condition()
+
+        self.number_of_throttled_responses = 0
+
+    def acquire(self):
+        """ blocks until the number of active requests is below the limit """
+
+        with self.condition:
+            while self.active_requests >= int(self.limit):
+                self.condition.wait()
+            self.active_requests += 1
+
+    def release(self, latency: Union[float, None], throttled: bool = False):
+        """ latency of the finished request in seconds, None if it failed without an answer of the server """
+
+        with self.condition:
+            self.active_requests -= 1
+
+            if latency is not None:
+                # the minimum of the smoothed latency is the baseline, so that single fast responses don't lower it
+                self.smoothed_latency = latency if self.smoothed_latency is None else 0.9 * self.smoothed_latency + 0.1 * latency
+                self.min_latency = self.smoothed_latency if self.min_latency is None else min(self.min_latency, self.smoothed_latency)
+                self.window_min_latency = self.smoothed_latency if self.window_min_latency is None else min(self.window_min_latency,
+                                                                                                            self.smoothed_latency)
+
+                # at the end of a window the baseline forgets the older windows
+                self.number_of_window_samples += 1
+                if self.number_of_window_samples >= self.baseline_window:
+                    self.min_latency = self.window_min_latency
+                    self.window_min_latency = None
+                    self.number_of_window_samples = 0
+
+            if throttled:
+                self.number_of_throttled_responses += 1
+
+            now = time.monotonic()
+            congested = throttled or (self.smoothed_latency is not None and
+                                      self.smoothed_latency > self.latency_tolerance * self.min_latency + 0.05)
+
+            if congested:
+                # decrease at most once per latency interval, requests that were already running would halve it again
+                if now - self.last_decrease_time > (self.smoothed_latency or 0):
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    self.last_decrease_time = now
+            elif latency is not None:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            self.condition.notify_all()
+
+    def get_statistics(self) -> Dict[str, float]:
+        with self.condition:
+            return {"concurrency_limit": int(self.limit),
+                    "active_requests": self.active_requests,
+                    "smoothed_latency": self.smoothed_latency or 0.0,
+                    "throttled_responses": self.number_of_throttled_responses}
@@ -0,0 +1,32 @@
+import re
+from typing import Sequence
+
+
+class TileUrlTemplate:
+    """ tile server url with {x}, {y}, {z} and optional {s} placeholder, parsed once and then filled for every tile,
+        {s} is replaced with one of subdomains, so that the requests are spread over several hosts,
+        each tile always gets the same host, so connection pools and HTTP caches stay consistent """
+
+    placeholder_pattern = re.compile(r"\{([xyzs])\}")
+
+    def __init__(self, template: str, subdomains: Sequence[str] = "abc"):
+        self.template = template
+        self.subdomains = tuple(subdomains) if len(subdomains) > 0 else ("",)
+
+        # template as format string with positional fields {0}=zoom, {1}=x, {2}=y, {3}=subdomain,
+        # other braces in the url are escaped
+        format_parts = []
+        last_end = 0
+        for match in self.placeholder_pattern.finditer(template):
+            format_parts.append(template[last_end:match.start()].replace("{", "{{").replace("}", "}}"))
+            format_parts.append("{" + str("zxys".index(match.group(1))) + "}")
+            last_end = match.end()
+        format_parts.append(template[last_end:].replace("{", "{{").replace("}", "}}"))
+
+        self.format_string = "".join(format_parts)
+
+    def get_subdomain(self, x: int, y: int) -> str:
+        return self.subdomains[(x + y) % len(self.subdomains)]
+
+    def get_url(self, zoom: int, x: int, y: int) -> str:
+        return self.format_string.format(zoom, x, y, self.subdomains[(x + y) % len(self.subdomains)])